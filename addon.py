@@ -1,16 +1,23 @@
+import asyncio
+import itertools
+import os
 import socket
 import re
 from multiprocessing.managers import BaseManager
-from queue import Queue, Empty
+from queue import Queue, Empty, Full
 import threading
 import time
 from pathlib import Path
-from typing import Any
-from datetime import datetime
-from mitmproxy import http, ctx
+from typing import Any, Optional
+from mitmproxy import command, http, ctx
 from mitmproxy.addonmanager import Loader
-from utils import SekaiTool, NetworkPackage
-from manager import QueueManager
+from utils import SekaiTool, NetworkPackage, HarvestPackage
+from manager import (QueueManager, LatestQueue, QUEUE_SIZE,
+                     get_transport_config)
+from transport import ShmSpool, DEFAULT_SPOOL_DIR
+from broker import BrokerProducer, BROKER_ADDRESS
+from spool import SpoolWriter
+from metrics import REGISTRY, SIZE_BUCKETS, stage_histogram
 
 PATTERNS = [
     r'https://.*\.colorfulpalette\.org/.*/mysekai\?isForceAllReloadOnlyMysekai=(True|False)',
@@ -20,11 +27,35 @@ PATTERNS = [
 # /api/user/123123123123123/mysekai?isForceAllReloadOnlyMysekai=True
 # /api/user/123123123123123/mysekai/birthday-party/2/delivery'
 
+HEARTBEAT_INTERVAL = 5
+SEND_BATCH = 16
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+HUB = os.environ.get('SEKAI_HUB', 'manager')
+
 
 class SekaiDataSender:
 
     def __init__(self):
-        self.queue: Queue = Queue(10)
+        # Latest packet per user, send_data never blocks the proxy.
+        self.queue = LatestQueue(QUEUE_SIZE)
+        self.pending: list = []
+        self.reconnect_delay = RECONNECT_MIN_DELAY
+        # 'auto' follows the transport advertised by the manager.
+        self.transport = 'auto'
+        # Hub to send to, 'manager' or 'broker'. A change is picked up by the
+        # running session when it is idle.
+        self.hub = HUB
+        self.broker_address = BROKER_ADDRESS
+        self.sent = REGISTRY.counter('sekai_addon_sent_packets',
+                                     'Packets handed to the hub')
+        self.batch_size = REGISTRY.histogram('sekai_addon_send_batch_size',
+                                             'Packets per put to the hub',
+                                             SIZE_BUCKETS)
+        for key in ['size', 'put', 'dropped', 'coalesced']:
+            REGISTRY.gauge(f'sekai_addon_queue_{key}',
+                           lambda key=key: self.queue.stats()[key],
+                           f'Sender queue {key}')
         self.thread = threading.Thread(target=self.sender_loop, daemon=True)
         self.thread.start()
 
@@ -38,61 +69,181 @@ class SekaiDataSender:
             q.put(data)
 
     def sender_loop(self):
-        pending_data = None
         while True:
-            manager = None
-            q = None
             try:
-                manager = QueueManager(address=('', 50000),
-                                       authkey=b'abracadabra')
-                manager.connect()
-                q: Queue = manager.get_queue()
-                print('Connected to manager at 50000')
-                while True:
-                    _ = q.qsize()
-
-                    if pending_data is None:
-                        try:
-                            pending_data = self.queue.get(timeout=5)
-                        except Empty:
-                            pass
-
-                    if pending_data is not None:
-                        q.put(pending_data)
-                        pending_data = None
-
+                if self.hub == 'broker':
+                    asyncio.run(self.broker_session())
+                else:
+                    self.manager_session()
             except Exception as ex:
+                # Pending packets are kept and resent after reconnecting.
                 print('Sender Exception:', type(ex), ex)
-                time.sleep(5)
-            finally:
-                del manager
-                del q
+                print(f'Reconnect in {self.reconnect_delay}s')
+                time.sleep(self.reconnect_delay)
+                self.reconnect_delay = min(self.reconnect_delay * 2,
+                                           RECONNECT_MAX_DELAY)
+
+    def manager_session(self):
+        manager = QueueManager(address=('', 50000), authkey=b'abracadabra')
+        manager.connect()
+        q: LatestQueue = manager.get_queue()
+        spool = self.open_spool(manager, None)
+        print('Connected to manager at 50000')
+        self.reconnect_delay = RECONNECT_MIN_DELAY
+        while self.hub == 'manager':
+            if not self.pending:
+                self.pending = self.take_batch(HEARTBEAT_INTERVAL)
+            if not self.pending:
+                # Idle: the transport lookup doubles as a heartbeat, so a
+                # dead manager is noticed before the next packet.
+                spool = self.open_spool(manager, spool)
+                continue
+
+            self.spool_pending(spool)
+            # A burst goes out as one list in a single round trip, the
+            # webapp flattens it again.
+            data = self.pending if len(self.pending) > 1 else self.pending[0]
+            with stage_histogram('put').time():
+                q.put(data)
+            self.sent_pending()
+
+    async def broker_session(self):
+        producer = await BrokerProducer.connect(self.broker_address)
+        try:
+            spool = self.select_spool(producer.transport, None)
+            print('Connected to broker at', self.broker_address)
+            self.reconnect_delay = RECONNECT_MIN_DELAY
+            while self.hub == 'broker':
+                if not self.pending:
+                    self.pending = await asyncio.to_thread(
+                        self.take_batch, HEARTBEAT_INTERVAL)
+                if not self.pending:
+                    await producer.ping()
+                    continue
+
+                self.spool_pending(spool)
+                with stage_histogram('put').time():
+                    await producer.put(self.pending)
+                self.sent_pending()
+        finally:
+            await producer.close()
+
+    def take_batch(self, timeout: float) -> list:
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except Empty:
+            return []
+        while len(batch) < SEND_BATCH:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def open_spool(self, manager: QueueManager,
+                   spool: Optional[ShmSpool]) -> Optional[ShmSpool]:
+        return self.select_spool(get_transport_config(manager), spool)
+
+    def select_spool(self, config: dict,
+                     spool: Optional[ShmSpool]) -> Optional[ShmSpool]:
+        transport = self.transport
+        if transport == 'auto':
+            transport = config['transport']
+        if transport != 'shm':
+            return None
+        spool_dir = Path(config['spool_dir'] or DEFAULT_SPOOL_DIR)
+        if spool is None or spool.spool_dir != spool_dir:
+            spool = ShmSpool(str(spool_dir))
+            print('Using shared memory spool at', spool.spool_dir)
+        return spool
+
+    def spool_pending(self, spool: Optional[ShmSpool]):
+        if spool:
+            with stage_histogram('spool').time():
+                self.pending = [
+                    spool.store(data)
+                    if isinstance(data, NetworkPackage) else data
+                    for data in self.pending
+                ]
+
+    def sent_pending(self):
+        self.sent.inc(len(self.pending))
+        self.batch_size.observe(len(self.pending))
+        self.pending = []
 
     def send_data(self, data: Any):
-        self.queue.put(data)
+        with stage_histogram('enqueue').time():
+            self.queue.put(data)
 
 
-class ShowSekai:
+class SekaiDecodeWorker:
 
-    def __init__(self):
-        self.data_sender = SekaiDataSender()
+    def __init__(self, data_sender: SekaiDataSender):
+        self.data_sender = data_sender
+        self.queue: Queue = Queue(10)
+        # Sequence of the newest forwarded packet submitted per user. A
+        # decoded packet is only sent if nothing newer for the user was
+        # submitted since, so an older map never follows a newer one into
+        # the latest-wins queue.
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.latest: dict[Optional[str], int] = {}
+        self.thread = threading.Thread(target=self.worker_loop, daemon=True)
+        self.thread.start()
 
-    def load(self, loader: Loader):
-        loader.add_option(
-            name='save_sekai',
-            typespec=bool,
-            default=False,
-            help='save packets for testing',
-        )
+    def worker_loop(self):
+        while True:
+            pack, seq, summary = self.queue.get()
+            self.handle_package(pack, seq, summary)
 
-    def try_find_diamond(self, data: bytes):
+    def submit(self, pack: NetworkPackage, forward: bool, summary: bool):
+        # Never block the proxy: a busy worker skips the summary, and packets
+        # that should have been decoded here go out raw to the webapp.
+        seq = None
+        if forward:
+            seq = next(self.counter)
+            with self.lock:
+                self.latest[SekaiTool.extract_user_id(pack.url)] = seq
         try:
-            decrypted_data = SekaiTool.decrypt_data(data)
-            harvest_count = SekaiTool.get_remain_harvest_count(decrypted_data)
-            print('harvest_count:', harvest_count)
-            ret = SekaiTool.find_diamond(decrypted_data, 12)
-            if ret is None:
+            self.queue.put_nowait((pack, seq, summary))
+        except Full:
+            print('Decode worker busy, skip packet')
+            if forward:
+                self.forward(pack, seq)
+
+    def forward(self, pack: NetworkPackage | HarvestPackage, seq: int):
+        user_id = SekaiTool.extract_user_id(pack.url)
+        with self.lock:
+            if self.latest.get(user_id) != seq:
+                # Superseded, the newer packet is queued or already sent.
                 return
+            del self.latest[user_id]
+            self.data_sender.send_data(pack)
+
+    def handle_package(self, pack: NetworkPackage, seq: Optional[int],
+                       summary: bool):
+        forward = seq is not None
+        try:
+            harvest_pack = SekaiTool.decode_package(pack)
+        except Exception as ex:
+            print('Exception:', ex)
+            if forward:
+                self.forward(pack, seq)
+            return
+
+        if forward:
+            self.forward(harvest_pack, seq)
+        if summary:
+            self.try_find_diamond(harvest_pack)
+
+    def try_find_diamond(self, harvest_pack: HarvestPackage):
+        try:
+            harvest_maps = harvest_pack.harvest_maps
+            if harvest_maps is None:
+                return
+            harvest_count = SekaiTool.count_remain_harvest(harvest_maps)
+            print('harvest_count:', harvest_count)
+            ret = SekaiTool.find_diamond_in_maps(harvest_maps, 12)
             if ret:
                 print('Find diamond')
                 for d in ret:
@@ -102,27 +253,123 @@ class ShowSekai:
         except Exception as ex:
             print('Exception:', ex)
 
-    @staticmethod
-    def get_time_filename():
-        curr = datetime.now()
-        return curr.strftime('packet_%Y%m%d_%H%M%S.bin')
+
+class ShowSekai:
+
+    def __init__(self):
+        self.data_sender = SekaiDataSender()
+        self.decode_worker = SekaiDecodeWorker(self.data_sender)
+        self.spool_writer: Optional[SpoolWriter] = None
+        self.stats_thread: Optional[threading.Thread] = None
+        self.captured = REGISTRY.counter('sekai_addon_captured_packets',
+                                         'Matched responses captured')
+
+    def load(self, loader: Loader):
+        loader.add_option(
+            name='save_sekai',
+            typespec=bool,
+            default=False,
+            help='append packets to a spool in sekai_data for replay',
+        )
+        loader.add_option(
+            name='sekai_summary',
+            typespec=bool,
+            default=True,
+            help='decrypt packets in a worker thread and print a summary',
+        )
+        loader.add_option(
+            name='sekai_decode',
+            typespec=bool,
+            default=False,
+            help='decode packets in the addon and send only the harvest maps',
+        )
+        loader.add_option(
+            name='sekai_transport',
+            typespec=str,
+            default='auto',
+            choices=['auto', 'queue', 'shm'],
+            help='payload transport to the manager, auto follows the manager',
+        )
+        loader.add_option(
+            name='sekai_hub',
+            typespec=str,
+            default=HUB,
+            choices=['manager', 'broker'],
+            help='send packets to the manager queue or the asyncio broker',
+        )
+        loader.add_option(
+            name='sekai_broker',
+            typespec=str,
+            default=BROKER_ADDRESS,
+            help='broker address, unix:/path or tcp:host:port',
+        )
+        loader.add_option(
+            name='sekai_queue_size',
+            typespec=int,
+            default=QUEUE_SIZE,
+            help='users with packets waiting to be sent, oldest is dropped',
+        )
+        loader.add_option(
+            name='sekai_stats_interval',
+            typespec=int,
+            default=0,
+            help='print the sekai.stats metrics every this many seconds, '
+            '0 to disable',
+        )
+
+    def configure(self, updated: set[str]):
+        if 'sekai_transport' in updated:
+            # Picked up by the sender on its next (re)connect.
+            self.data_sender.transport = ctx.options.sekai_transport
+        if 'sekai_broker' in updated:
+            self.data_sender.broker_address = ctx.options.sekai_broker
+        if 'sekai_hub' in updated:
+            self.data_sender.hub = ctx.options.sekai_hub
+        if 'sekai_queue_size' in updated:
+            self.data_sender.queue.maxsize = ctx.options.sekai_queue_size
+        if ('sekai_stats_interval' in updated
+                and ctx.options.sekai_stats_interval > 0
+                and self.stats_thread is None):
+            self.stats_thread = threading.Thread(target=self.stats_loop,
+                                                 daemon=True)
+            self.stats_thread.start()
+
+    @command.command('sekai.stats')
+    def stats(self) -> str:
+        '''Per-stage latency and throughput in the Prometheus text format.'''
+        return REGISTRY.render()
+
+    def stats_loop(self):
+        while True:
+            interval = ctx.options.sekai_stats_interval
+            if interval <= 0:
+                # Disabled again, sleep until it is turned back on.
+                time.sleep(1)
+                continue
+            time.sleep(interval)
+            print(REGISTRY.render(), end='')
 
     def handle_matched_flow(self, flow: http.HTTPFlow):
         data = flow.response.content
         if data:
-            pack = NetworkPackage(flow.request.pretty_url, data)
+            with stage_histogram('capture').time():
+                self.capture(flow.request.pretty_url, data)
+
+    def capture(self, url: str, data: bytes):
+        self.captured.inc()
+        pack = NetworkPackage(url, data, time.time())
+        forward = ctx.options.sekai_decode
+        summary = ctx.options.sekai_summary
+        if not forward:
             self.data_sender.send_data(pack)
-            self.try_find_diamond(data)
-
-            if ctx.options.save_sekai:
-                try:
-                    sekai_data_dir = Path('sekai_data')
-                    sekai_data_dir.mkdir(exist_ok=True)
-                    filename = sekai_data_dir / self.get_time_filename()
-                    filename.write_bytes(data)
-                    print('Save to', filename)
-                except Exception as ex:
-                    print('Error on save packet:', type(ex), ex)
+        if forward or summary:
+            self.decode_worker.submit(pack, forward, summary)
+
+        if ctx.options.save_sekai:
+            if self.spool_writer is None:
+                self.spool_writer = SpoolWriter()
+                print('Save packets to', self.spool_writer.index_path)
+            self.spool_writer.append(pack.url, data, pack.captured)
 
     def response(self, flow: http.HTTPFlow):
         if 'colorfulpalette.org' in flow.request.pretty_url:
@@ -0,0 +1,392 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from pathlib import Path
+from typing import Any, Callable
+
+import msgpack
+from sssekai.crypto.APIManager import (encrypt, decrypt,
+                                       SEKAI_APIMANAGER_KEYSETS)
+
+from utils import (SekaiDecryptor, SekaiTool, HarvestMapTable,
+                   HARVEST_MAP_PATHS)
+from synthetic import make_harvest_maps, make_packet, make_response
+
+KEYSET = SEKAI_APIMANAGER_KEYSETS['jp']
+SUITES = ['decrypt', 'analysis', 'transport', 'e2e']
+
+
+def make_payload(size: int) -> bytes:
+    # A msgpack map padded with small records until it reaches about size
+    # bytes, similar in shape to a mysekai reload response.
+    records = []
+    packed = b''
+    while len(packed) < size:
+        records.extend({
+            'id': i,
+            'resourceType': 'mysekai_material',
+            'positionX': i % 40,
+            'positionZ': -(i % 40),
+        } for i in range(len(records), len(records) + 256))
+        packed = msgpack.packb({'updatedResources': {'records': records}})
+    return encrypt(packed, KEYSET)
+
+
+def timed(name: str, func: Callable, number: int,
+          **params) -> dict[str, Any]:
+    # Best and median of 5 repeats, per call.
+    times = [
+        t / number
+        for t in timeit.repeat(func, number=number, repeat=5)
+    ]
+    return {
+        'name': name,
+        'params': params,
+        'samples': len(times) * number,
+        'best_ms': min(times) * 1000,
+        'median_ms': statistics.median(times) * 1000,
+        'ops_per_s': 1 / min(times),
+    }
+
+
+def latency(name: str, samples: list[float], elapsed: float,
+            **params) -> dict[str, Any]:
+    # samples are seconds per message, elapsed the wall time of all of them.
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000
+
+    return {
+        'name': name,
+        'params': params,
+        'samples': len(samples),
+        'best_ms': ordered[0] * 1000,
+        'median_ms': statistics.median(ordered) * 1000,
+        'p95_ms': pick(0.95),
+        'p99_ms': pick(0.99),
+        'max_ms': ordered[-1] * 1000,
+        'ops_per_s': len(samples) / elapsed,
+    }
+
+
+def bench_decrypt(args) -> list[dict[str, Any]]:
+    decryptor = SekaiDecryptor()
+    cases = {
+        'decrypt': lambda data: decrypt(data, KEYSET),
+        'decryptor': decryptor.decrypt,
+        'decrypt+unpackb': lambda data: msgpack.unpackb(decrypt(data, KEYSET)),
+        'decryptor+unpackb':
+        lambda data: msgpack.unpackb(decryptor.decrypt(data)),
+    }
+    results = []
+    for size in args.sizes:
+        data = make_payload(size)
+        for name, func in cases.items():
+            results.append(
+                timed(name, lambda: func(data), args.number, size=len(data)))
+    return results
+
+
+def bench_analysis(args) -> list[dict[str, Any]]:
+    harvest_maps = make_harvest_maps(args.sites, args.drops, args.fixtures)
+    pack = make_packet('1', harvest_maps)
+    decrypted = make_response(harvest_maps)
+    table = HarvestMapTable.from_harvest_maps(harvest_maps)
+    params = {
+        'sites': args.sites,
+        'drops': args.drops,
+        'fixtures': args.fixtures,
+        'size': len(pack.data),
+    }
+    cases = {
+        'decrypt_data':
+        lambda: SekaiTool.decrypt_data(pack.data),
+        'decrypt_data(paths)':
+        lambda: SekaiTool.decrypt_data(pack.data, HARVEST_MAP_PATHS),
+        'process_package':
+        lambda: SekaiTool.process_package(pack),
+        'HarvestMapTable':
+        lambda: HarvestMapTable.from_harvest_maps(harvest_maps),
+        'find_diamond':
+        lambda: SekaiTool.find_diamond(decrypted, 12),
+        'find_diamond_in_maps(table)':
+        lambda: SekaiTool.find_diamond_in_maps(table, 12),
+        'extract_resources':
+        lambda: SekaiTool.extract_resources(table, 'mysekai_material', 12),
+        'current_exist_ids':
+        lambda: SekaiTool.current_exist_ids(table),
+    }
+    return [
+        timed(name, func, args.number, **params)
+        for name, func in cases.items()
+    ]
+
+
+class HubProcess:
+    '''manager.py in manager or broker mode as a child process.'''
+
+    def __init__(self, mode: str, queue_size: int) -> None:
+        self.mode = mode
+        self.address = None
+        cmd = [
+            sys.executable, 'manager.py', '--mode', mode, '--queue-size',
+            str(queue_size)
+        ]
+        if mode == 'broker':
+            self.address = 'unix:' + os.path.join(tempfile.mkdtemp(),
+                                                  'broker.sock')
+            cmd += ['--broker-address', self.address]
+        self.process = subprocess.Popen(cmd,
+                                        cwd=Path(__file__).parent,
+                                        stdout=subprocess.DEVNULL)
+
+    def __enter__(self):
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'{self.mode} exited, is port 50000 or '
+                                   'the socket already in use?')
+            try:
+                if self.mode == 'broker':
+                    asyncio.run(self.ping_broker())
+                else:
+                    self.connect_manager()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        raise TimeoutError(f'{self.mode} did not start')
+
+    def __exit__(self, *exc):
+        self.process.kill()
+        self.process.wait()
+
+    def connect_manager(self):
+        from manager import QueueManager
+        manager = QueueManager(address=('', 50000), authkey=b'abracadabra')
+        manager.connect()
+        return manager
+
+    async def ping_broker(self):
+        from broker import BrokerClient
+        client = await BrokerClient.connect(self.address)
+        await client.close()
+
+
+def bench_manager_transport(packs: list, number: int) -> list[dict[str, Any]]:
+    with HubProcess('manager', len(packs)) as hub:
+        q = hub.connect_manager().get_queue()
+        samples = []
+        start = time.perf_counter()
+        for i in range(number):
+            t = time.perf_counter()
+            q.put(packs[i % len(packs)])
+            q.get()
+            samples.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+        results = [latency('manager put+get', samples, elapsed)]
+
+        # Throughput with a producer thread and a draining consumer. The
+        # producer connects first, so only the transport is timed. Each
+        # sample is one packet's time from put until it was received.
+        producer = hub.connect_manager().get_queue()
+        ready = threading.Event()
+        put_times: list[float] = []
+
+        def produce():
+            # Proxies reconnect per thread, do it before the timed part.
+            producer.qsize()
+            ready.set()
+            for pack in packs:
+                put_times.append(time.perf_counter())
+                producer.put(pack)
+
+        thread = threading.Thread(target=produce)
+        thread.start()
+        ready.wait()
+        start = time.perf_counter()
+        received = []
+        while len(received) < len(packs):
+            q.get()
+            received.append(time.perf_counter())
+        thread.join()
+        elapsed = time.perf_counter() - start
+        results.append(
+            latency('manager stream',
+                    [r - p for p, r in zip(put_times, received)], elapsed))
+    return results
+
+
+def bench_broker_transport(packs: list, number: int) -> list[dict[str, Any]]:
+    from broker import BrokerProducer, BrokerConsumer
+
+    async def run(address: str):
+        producer = await BrokerProducer.connect(address)
+        consumer = await BrokerConsumer.connect(address)
+        samples = []
+        start = time.perf_counter()
+        for i in range(number):
+            t = time.perf_counter()
+            await producer.put([packs[i % len(packs)]])
+            await consumer.get(1, 5)
+            samples.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+        results = [latency('broker put+get', samples, elapsed)]
+
+        put_times: list[float] = []
+
+        async def produce():
+            for pack in packs:
+                put_times.append(time.perf_counter())
+                await producer.put([pack])
+
+        start = time.perf_counter()
+        task = asyncio.create_task(produce())
+        received = []
+        while len(received) < len(packs):
+            items = await consumer.get(32, 5)
+            received.extend([time.perf_counter()] * len(items))
+        await task
+        elapsed = time.perf_counter() - start
+        results.append(
+            latency('broker stream',
+                    [r - p for p, r in zip(put_times, received)], elapsed))
+        await producer.close()
+        await consumer.close()
+        return results
+
+    with HubProcess('broker', len(packs)) as hub:
+        return asyncio.run(run(hub.address))
+
+
+def bench_transport(args) -> list[dict[str, Any]]:
+    harvest_maps = make_harvest_maps(args.sites, args.drops, args.fixtures)
+    # Distinct users so the coalescing queues keep every packet.
+    packs = [make_packet(str(i), harvest_maps) for i in range(args.number)]
+    params = {'size': len(packs[0].data)}
+    results = (bench_manager_transport(packs, args.number) +
+               bench_broker_transport(packs, args.number))
+    for result in results:
+        result['params'] = params
+    return results
+
+
+def bench_e2e(args) -> list[dict[str, Any]]:
+    # Packet put on the manager queue until webapp emits the user event.
+    import webapp
+    webapp.PacketWorkerPool.INSTANCE = webapp.PacketWorkerPool(args.workers)
+    storage = webapp.Storage.instance()
+    harvest_maps = make_harvest_maps(args.sites, args.drops, args.fixtures)
+    # One extra packet first, so starting the worker pool is not measured.
+    packs = [
+        make_packet(str(i), harvest_maps) for i in range(args.number + 1)
+    ]
+    emitted: dict[str, float] = {}
+    emit_event = storage.emit_event
+
+    def record_emit(user_id):
+        emitted[user_id] = time.perf_counter()
+        emit_event(user_id)
+
+    storage.emit_event = record_emit
+
+    async def run(q):
+        task = asyncio.create_task(webapp.background_handle())
+        samples = []
+        start = time.perf_counter()
+        for i, pack in enumerate(packs):
+            user_id = SekaiTool.extract_user_id(pack.url)
+            t = time.perf_counter()
+            await asyncio.to_thread(q.put, pack)
+            while user_id not in emitted:
+                await asyncio.sleep(0.0005)
+            if i == 0:
+                start = time.perf_counter()
+                continue
+            samples.append(emitted[user_id] - t)
+        elapsed = time.perf_counter() - start
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return samples, elapsed
+
+    try:
+        with HubProcess('manager', len(packs)) as hub:
+            q = hub.connect_manager().get_queue()
+            samples, elapsed = asyncio.run(run(q))
+    finally:
+        webapp.PacketWorkerPool.instance().shutdown()
+    return [
+        latency('packet to emit_event',
+                samples,
+                elapsed,
+                sites=args.sites,
+                drops=args.drops,
+                fixtures=args.fixtures,
+                workers=args.workers,
+                size=len(packs[0].data))
+    ]
+
+
+def print_results(results: list[dict[str, Any]]):
+    print(f'{"case":<30}{"median ms":>12}{"best ms":>12}{"ops/s":>12}'
+          '  params')
+    for r in results:
+        params = ' '.join(f'{k}={v}' for k, v in r['params'].items())
+        print(f'{r["name"]:<30}{r["median_ms"]:>12.3f}{r["best_ms"]:>12.3f}'
+              f'{r["ops_per_s"]:>12.1f}  {params}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--suite',
+                        choices=SUITES,
+                        nargs='+',
+                        default=['decrypt', 'analysis'])
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[16 * 1024, 256 * 1024, 1024 * 1024])
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--sites', type=int, default=4)
+    parser.add_argument('--drops', type=int, default=200)
+    parser.add_argument('--fixtures', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    suites = {
+        'decrypt': bench_decrypt,
+        'analysis': bench_analysis,
+        'transport': bench_transport,
+        'e2e': bench_e2e,
+    }
+    results = []
+    for suite in args.suite:
+        for result in suites[suite](args):
+            result['suite'] = suite
+            results.append(result)
+    print_results(results)
+
+    if args.json:
+        report = {
+            'time': time.time(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args),
+            'results': results,
+        }
+        Path(args.json).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+import asyncio
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import msgpack
+
+from utils import NetworkPackage, HarvestPackage
+from transport import SpoolPackage
+from manager import LatestQueue, QUEUE_SIZE, discard_package
+
+BROKER_ADDRESS = os.environ.get('SEKAI_BROKER',
+                                'unix:/tmp/sekai_broker.sock')
+DEFAULT_GROUP = 'webapp'
+HEADER = struct.Struct('>I')
+MAX_FRAME = 64 * 1024 * 1024
+# Seconds a group without consumers is kept, so a restarting webapp finds
+# its packets waiting.
+GROUP_EXPIRY = 60
+
+
+def parse_address(address: str) -> tuple[str, Any]:
+    # 'unix:/path/to.sock' or 'tcp:host:port'
+    kind, _, target = address.partition(':')
+    if kind == 'unix':
+        return kind, target
+    if kind == 'tcp':
+        host, _, port = target.rpartition(':')
+        return kind, (host or '127.0.0.1', int(port))
+    raise ValueError(f'Unknown broker address {address}')
+
+
+def pack_item(pack: NetworkPackage | HarvestPackage | SpoolPackage) -> dict:
+    if isinstance(pack, NetworkPackage):
+        return {
+            'type': 'network',
+            'url': pack.url,
+            'data': pack.data,
+            'captured': pack.captured
+        }
+    if isinstance(pack, HarvestPackage):
+        return {
+            'type': 'harvest',
+            'url': pack.url,
+            'harvest_maps': pack.harvest_maps,
+            'captured': pack.captured
+        }
+    if isinstance(pack, SpoolPackage):
+        return {
+            'type': 'spool',
+            'url': pack.url,
+            'path': pack.path,
+            'length': pack.length,
+            'captured': pack.captured
+        }
+    raise TypeError(f'Cannot send {type(pack)}')
+
+
+def unpack_item(item: dict) -> NetworkPackage | HarvestPackage | SpoolPackage:
+    kind = item['type']
+    captured = item.get('captured', 0.0)
+    if kind == 'network':
+        return NetworkPackage(item['url'], item['data'], captured)
+    if kind == 'harvest':
+        return HarvestPackage(item['url'], item['harvest_maps'], captured)
+    if kind == 'spool':
+        return SpoolPackage(item['url'], item['path'], item['length'],
+                            captured)
+    raise ValueError(f'Unknown item type {kind}')
+
+
+async def read_frame(reader: asyncio.StreamReader) -> dict:
+    header = await reader.readexactly(HEADER.size)
+    (size, ) = HEADER.unpack(header)
+    if size > MAX_FRAME:
+        raise ValueError(f'Frame too large: {size}')
+    body = await reader.readexactly(size)
+    return msgpack.unpackb(body, strict_map_key=False)
+
+
+def write_frame(writer: asyncio.StreamWriter, msg: dict):
+    body = msgpack.packb(msg)
+    writer.write(HEADER.pack(len(body)))
+    writer.write(body)
+
+
+async def open_connection(address: str):
+    kind, target = parse_address(address)
+    if kind == 'unix':
+        return await asyncio.open_unix_connection(target)
+    return await asyncio.open_connection(*target)
+
+
+class ConsumerGroup:
+    '''Every group sees every packet, consumers in a group share them.'''
+
+    def __init__(self,
+                 maxsize: int,
+                 on_drop: Optional[Callable[[Any], None]] = None) -> None:
+        self.queue = LatestQueue(maxsize, on_drop=on_drop)
+        self.ready = asyncio.Event()
+        self.consumers = 0
+        self.idle_since = time.monotonic()
+
+    def put(self, items: list):
+        self.queue.put(items)
+        self.ready.set()
+
+    def requeue(self, items: list):
+        self.queue.requeue(items)
+        self.ready.set()
+
+    def attach(self):
+        self.consumers += 1
+
+    def detach(self):
+        self.consumers -= 1
+        if self.consumers == 0:
+            self.idle_since = time.monotonic()
+
+    async def get(self, max_items: int, timeout: float,
+                  gone: Callable[[], bool]) -> list:
+        if self.queue.empty():
+            try:
+                async with asyncio.timeout(timeout):
+                    while self.queue.empty():
+                        self.ready.clear()
+                        await self.ready.wait()
+            except TimeoutError:
+                return []
+        # Nothing is taken for a consumer that disconnected while waiting.
+        if gone():
+            return []
+        items = []
+        while len(items) < max_items and not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        return items
+
+
+class Broker:
+    '''Asyncio replacement for the manager queue.
+
+    Clients talk length-prefixed msgpack frames over a Unix socket or TCP.
+    Producers' puts are acknowledged once queued, consumers pull batches
+    from a named group. Spooled payloads are unlinked by their first reader, so
+    the shm transport only works with a single consumer group. A group
+    whose consumers are all gone expires after GROUP_EXPIRY, once another
+    group has a consumer.
+    '''
+
+    def __init__(self,
+                 queue_size: int = QUEUE_SIZE,
+                 transport: Optional[dict] = None) -> None:
+        self.queue_size = queue_size
+        self.transport = transport or {
+            'transport': 'queue',
+            'spool_dir': None
+        }
+        self.groups: dict[str, ConsumerGroup] = {}
+        self.group(DEFAULT_GROUP)
+
+    def group(self, name: str) -> ConsumerGroup:
+        group = self.groups.get(name)
+        if group is None:
+            group = ConsumerGroup(self.queue_size, self.drop_package)
+            self.groups[name] = group
+        return group
+
+    def drop_package(self, item: Any):
+        # With several groups the same descriptor may still be queued in
+        # another one, the manager's spool sweep removes it later.
+        if len(self.groups) == 1:
+            discard_package(item)
+
+    def expire_groups(self):
+        if not any(g.consumers for g in self.groups.values()):
+            return
+        deadline = time.monotonic() - GROUP_EXPIRY
+        for name, group in list(self.groups.items()):
+            if not group.consumers and group.idle_since < deadline:
+                print(f'Expire consumer group {name}, '
+                      f'{group.queue.qsize()} packets left')
+                del self.groups[name]
+
+    def publish(self, items: list):
+        self.expire_groups()
+        for group in self.groups.values():
+            group.put(items)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {name: g.queue.stats() for name, g in self.groups.items()}
+
+    async def handle_client(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter):
+        consumer_of: Optional[ConsumerGroup] = None
+
+        def gone() -> bool:
+            # The client sends nothing while it waits for a reply, so EOF
+            # is seen here without reading.
+            return reader.at_eof() or writer.is_closing()
+
+        try:
+            while True:
+                msg = await read_frame(reader)
+                op = msg.get('op')
+                if op == 'get':
+                    group = self.group(msg.get('group', DEFAULT_GROUP))
+                    items = await group.get(msg['max'], msg['timeout'], gone)
+                    try:
+                        write_frame(
+                            writer, {
+                                'op': 'items',
+                                'items': [pack_item(i) for i in items],
+                                'pending': group.queue.qsize()
+                            })
+                        await writer.drain()
+                    except ConnectionError:
+                        if items:
+                            print(f'Consumer gone, requeue {len(items)} '
+                                  'packets')
+                            group.requeue(items)
+                        raise
+                    continue
+                if op == 'put':
+                    self.publish([unpack_item(i) for i in msg['items']])
+                    write_frame(writer, {
+                        'op': 'ack',
+                        'count': len(msg['items'])
+                    })
+                elif op == 'hello':
+                    group = self.group(msg.get('group', DEFAULT_GROUP))
+                    if msg.get('role') == 'consumer' and consumer_of is None:
+                        consumer_of = group
+                        group.attach()
+                    write_frame(writer, {'op': 'welcome', **self.transport})
+                elif op == 'ping':
+                    write_frame(writer, {'op': 'pong'})
+                elif op == 'stats':
+                    write_frame(writer, {'op': 'stats', 'groups': self.stats()})
+                else:
+                    raise ValueError(f'Unknown op {op}')
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as ex:
+            print('Broker client exception:', type(ex), ex)
+        finally:
+            if consumer_of is not None:
+                consumer_of.detach()
+            writer.close()
+
+    async def serve(self, address: str):
+        kind, target = parse_address(address)
+        if kind == 'unix':
+            path = Path(target)
+            if path.is_socket():
+                path.unlink()
+            server = await asyncio.start_unix_server(self.handle_client,
+                                                     target)
+            os.chmod(target, 0o600)
+        else:
+            server = await asyncio.start_server(self.handle_client, *target)
+        print('Starting broker on', address)
+        async with server:
+            await server.serve_forever()
+
+
+class BrokerClient:
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.transport: dict = {'transport': 'queue', 'spool_dir': None}
+
+    @classmethod
+    async def connect(cls, address: str = BROKER_ADDRESS, **hello):
+        reader, writer = await open_connection(address)
+        client = cls(reader, writer)
+        reply = await client.request({'op': 'hello', **hello})
+        reply.pop('op', None)
+        client.transport = reply
+        return client
+
+    async def request(self, msg: dict) -> dict:
+        write_frame(self.writer, msg)
+        await self.writer.drain()
+        return await read_frame(self.reader)
+
+    async def ping(self):
+        await self.request({'op': 'ping'})
+
+    async def stats(self) -> dict[str, dict[str, int]]:
+        return (await self.request({'op': 'stats'}))['groups']
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+class BrokerProducer(BrokerClient):
+
+    @classmethod
+    async def connect(cls, address: str = BROKER_ADDRESS):
+        return await super().connect(address, role='producer')
+
+    async def put(self, packs: list):
+        # Returns once the broker has queued the packets, so a caller only
+        # forgets them after they are safe.
+        await self.request({
+            'op': 'put',
+            'items': [pack_item(p) for p in packs]
+        })
+
+
+class BrokerConsumer(BrokerClient):
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter) -> None:
+        super().__init__(reader, writer)
+        self.group = DEFAULT_GROUP
+        # Packets left in the group after the last get.
+        self.pending = 0
+
+    @classmethod
+    async def connect(cls,
+                      address: str = BROKER_ADDRESS,
+                      group: str = DEFAULT_GROUP):
+        client = await super().connect(address, role='consumer', group=group)
+        client.group = group
+        return client
+
+    async def get(self, max_items: int, timeout: float) -> list:
+        reply = await self.request({
+            'op': 'get',
+            'group': self.group,
+            'max': max_items,
+            'timeout': timeout
+        })
+        self.pending = reply.get('pending', 0)
+        return [unpack_item(i) for i in reply['items']]
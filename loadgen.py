@@ -0,0 +1,103 @@
+import argparse
+import os
+import time
+
+from utils import NetworkPackage
+from synthetic import (make_harvest_maps, make_response, make_url,
+                       encrypt_response)
+
+
+def build_payloads(args) -> list[bytes]:
+    # A few distinct encrypted responses, shared by all fake users. The URL
+    # alone decides which user a packet belongs to.
+    payloads = []
+    for seed in range(args.variants):
+        harvest_maps = make_harvest_maps(args.sites, args.drops, args.fixtures,
+                                         seed)
+        response = make_response(harvest_maps, args.extra_records, seed)
+        payloads.append(encrypt_response(response))
+    return payloads
+
+
+def wait_drained(sender, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if sender.queue.empty() and not sender.pending:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='feed synthetic packets through SekaiDataSender')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--rate',
+                        type=float,
+                        default=10,
+                        help='packets per second, 0 as fast as possible')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--sites', type=int, default=4)
+    parser.add_argument('--drops', type=int, default=200)
+    parser.add_argument('--fixtures', type=int, default=100)
+    parser.add_argument('--extra-records', type=int, default=2000)
+    parser.add_argument('--variants', type=int, default=8)
+    parser.add_argument('--user-base', type=int, default=900000000000000)
+    parser.add_argument('--hub', choices=['manager', 'broker'])
+    parser.add_argument('--broker')
+    parser.add_argument('--transport', choices=['auto', 'queue', 'shm'])
+    parser.add_argument('--queue-size', type=int)
+    args = parser.parse_args()
+
+    payloads = build_payloads(args)
+    print(f'{len(payloads)} payloads of {len(payloads[0])} bytes, '
+          f'{args.users} users')
+
+    # The addon's own sender, configured the way mitmproxy options would.
+    # Its thread starts on import, so the hub is set through the environment.
+    if args.hub:
+        os.environ['SEKAI_HUB'] = args.hub
+    if args.broker:
+        os.environ['SEKAI_BROKER'] = args.broker
+    import addon
+    sender = addon.addons[0].data_sender
+    if args.transport:
+        sender.transport = args.transport
+    if args.queue_size:
+        sender.queue.maxsize = args.queue_size
+
+    urls = [make_url(str(args.user_base + i)) for i in range(args.users)]
+    interval = 1 / args.rate if args.rate > 0 else 0
+    start = time.monotonic()
+    next_send = start
+    next_report = start + 1
+    sent = 0
+    while time.monotonic() - start < args.duration:
+        if interval:
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_send += interval
+        data = payloads[sent % len(payloads)]
+        sender.send_data(
+            NetworkPackage(urls[sent % len(urls)], data, time.time()))
+        sent += 1
+        now = time.monotonic()
+        if now >= next_report:
+            stats = sender.queue.stats()
+            print(f'{now - start:6.1f}s sent {sent} '
+                  f'({sent / (now - start):.1f}/s) queued {stats["size"]} '
+                  f'coalesced {stats["coalesced"]} dropped {stats["dropped"]}')
+            next_report += 1
+
+    elapsed = time.monotonic() - start
+    drained = wait_drained(sender, 30)
+    stats = sender.queue.stats()
+    delivered = stats['put'] - stats['coalesced'] - stats['dropped']
+    print(f'Sent {sent} packets in {elapsed:.1f}s ({sent / elapsed:.1f}/s), '
+          f'{delivered} handed to the hub, coalesced {stats["coalesced"]}, '
+          f'dropped {stats["dropped"]}' + ('' if drained else ', not drained'))
+
+
+if __name__ == '__main__':
+    main()
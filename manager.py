@@ -1,12 +1,151 @@
-from queue import Queue
-from multiprocessing.managers import BaseManager
+import argparse
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from queue import Empty
+from multiprocessing.managers import BaseManager, DictProxy, RemoteError
+from typing import Any, Callable, Optional
+
+from utils import SekaiTool
+from transport import (TRANSPORTS, DEFAULT_SPOOL_DIR, ShmSpool, SpoolPackage,
+                       discard)
+
+QUEUE_SIZE = 10
+SPOOL_CLEANUP_INTERVAL = 60
+SPOOL_MAX_AGE = 300
+
+
+def unpack_batch(item) -> list:
+    # Senders may put a list of packets as one queue item.
+    return item if isinstance(item, list) else [item]
+
+
+def discard_package(item: Any):
+    # Dropped descriptors would otherwise leave their payload in the spool.
+    if isinstance(item, SpoolPackage):
+        discard(item)
+
+
+class LatestQueue:
+    '''Bounded queue that keeps only the latest packet per user.
+
+    A packet for a user already waiting replaces the queued one in place,
+    a packet for a new user evicts the oldest entry when full. put never
+    blocks, so a stalled consumer cannot back pressure into the proxy.
+    The get/put_nowait/get_nowait/qsize interface follows queue.Queue.
+    '''
+
+    def __init__(self,
+                 maxsize: int = QUEUE_SIZE,
+                 on_drop: Optional[Callable[[Any], None]] = None) -> None:
+        self.maxsize = maxsize
+        self.on_drop = on_drop
+        self.items: OrderedDict[Any, Any] = OrderedDict()
+        self.cond = threading.Condition()
+        self.counter = itertools.count()
+        self.put_count = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def key(self, item: Any):
+        url = getattr(item, 'url', None)
+        user_id = SekaiTool.extract_user_id(url) if url else None
+        # Packets without a user are never coalesced.
+        return user_id or ('', next(self.counter))
+
+    def put(self, item: Any, block=True, timeout=None):
+        # block and timeout are accepted for queue.Queue compatibility.
+        removed = []
+        with self.cond:
+            for data in unpack_batch(item):
+                self.put_count += 1
+                key = self.key(data)
+                if key in self.items:
+                    removed.append(self.items[key])
+                    self.items[key] = data
+                    self.coalesced += 1
+                    continue
+                while self.items and len(self.items) >= max(self.maxsize, 1):
+                    removed.append(self.items.popitem(last=False)[1])
+                    self.dropped += 1
+                self.items[key] = data
+            self.cond.notify_all()
+        for data in removed:
+            self.drop(data)
+
+    def put_nowait(self, item: Any):
+        self.put(item)
+
+    def requeue(self, items: list):
+        # Give back packets taken by a consumer that went away. They go in
+        # front in their original order, unless a newer packet for the same
+        # user arrived meanwhile.
+        removed = []
+        with self.cond:
+            for data in reversed(items):
+                key = self.key(data)
+                if key in self.items:
+                    removed.append(data)
+                    continue
+                self.items[key] = data
+                self.items.move_to_end(key, last=False)
+            while len(self.items) > max(self.maxsize, 1):
+                removed.append(self.items.popitem(last=False)[1])
+                self.dropped += 1
+            self.cond.notify_all()
+        for data in removed:
+            self.drop(data)
+
+    def drop(self, item: Any):
+        if self.on_drop is None:
+            return
+        try:
+            self.on_drop(item)
+        except Exception as ex:
+            print('Drop hook exception:', type(ex), ex)
+
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            if block and not self.cond.wait_for(lambda: self.items, timeout):
+                raise Empty
+            if not self.items:
+                raise Empty
+            return self.items.popitem(last=False)[1]
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self) -> int:
+        with self.cond:
+            return len(self.items)
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def full(self) -> bool:
+        return self.qsize() >= self.maxsize
+
+    def stats(self) -> dict[str, int]:
+        with self.cond:
+            return {
+                'size': len(self.items),
+                'maxsize': self.maxsize,
+                'put': self.put_count,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+            }
 
 
 class Storage:
     INSTANCE = None
 
     def __init__(self) -> None:
-        self.queue = Queue(10)
+        self.queue = LatestQueue(QUEUE_SIZE, on_drop=discard_package)
+        # Payload transport advertised to senders: 'queue' pickles the bytes
+        # through the queue, 'shm' passes SpoolPackage descriptors.
+        self.transport = {'transport': 'queue', 'spool_dir': None}
 
     @classmethod
     def get_instance(cls):
@@ -16,18 +155,73 @@ class Storage:
 
 
 class QueueManager(BaseManager):
-    get_queue: type[Queue]
+    get_queue: type[LatestQueue]
+    get_transport: type[dict]
     pass
 
 
 QueueManager.register('get_queue',
                       callable=lambda: Storage.get_instance().queue)
+QueueManager.register('get_transport',
+                      callable=lambda: Storage.get_instance().transport,
+                      proxytype=DictProxy)
+
+
+def get_transport_config(manager: QueueManager) -> dict:
+    # Older managers do not expose the transport, they only speak 'queue'.
+    # Connection errors are raised so callers can use this as a heartbeat.
+    try:
+        return manager.get_transport().copy()
+    except RemoteError:
+        return {'transport': 'queue', 'spool_dir': None}
+
+
+def spool_cleanup_loop(transport: dict):
+    # The webapp can switch the advertised transport at any time, so the
+    # config is read again on every sweep. /dev/shm is memory, payloads
+    # whose descriptor was lost must not stay there.
+    spool: Optional[ShmSpool] = None
+    while True:
+        time.sleep(SPOOL_CLEANUP_INTERVAL)
+        if transport['transport'] != 'shm':
+            continue
+        spool_dir = transport['spool_dir'] or DEFAULT_SPOOL_DIR
+        if spool is None or spool.spool_dir != Path(spool_dir):
+            spool = ShmSpool(spool_dir)
+        removed = spool.cleanup(SPOOL_MAX_AGE)
+        if removed:
+            print(f'Removed {removed} stale spool files')
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['manager', 'broker'],
+                        default='manager')
+    parser.add_argument('--broker-address', default=None)
+    parser.add_argument('--transport', choices=TRANSPORTS, default='queue')
+    parser.add_argument('--spool-dir', default=DEFAULT_SPOOL_DIR)
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE)
+    args = parser.parse_args()
+
+    storage = Storage.get_instance()
+    storage.queue.maxsize = args.queue_size
+    storage.transport['transport'] = args.transport
+    if args.transport == 'shm':
+        storage.transport['spool_dir'] = args.spool_dir
+    threading.Thread(target=spool_cleanup_loop,
+                     args=(storage.transport, ),
+                     daemon=True).start()
+
+    if args.mode == 'broker':
+        import asyncio
+        from broker import Broker, BROKER_ADDRESS
+        broker = Broker(args.queue_size, storage.transport)
+        asyncio.run(broker.serve(args.broker_address or BROKER_ADDRESS))
+        return
+
     manager = QueueManager(address=('', 50000), authkey=b'abracadabra')
     server = manager.get_server()
-    print('Starting manager server on port 50000')
+    print(f'Starting manager server on port 50000 ({args.transport})')
     server.serve_forever()
 
 
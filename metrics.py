@@ -0,0 +1,163 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+# Seconds, from sub-millisecond decode steps up to queueing delays.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def format_labels(labels: tuple[tuple[str, str], ...],
+                  extra: Optional[tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    inner = ','.join(f'{k}="{v}"' for k, v in items)
+    return '{' + inner + '}'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name: str, labels):
+        yield name + '_total' + format_labels(labels), self.value
+
+
+class Gauge:
+    # Read from a callback when rendered, so nothing has to keep it fresh.
+
+    def __init__(self, func: Callable[[], float]) -> None:
+        self.func = func
+
+    def samples(self, name: str, labels):
+        try:
+            value = self.func()
+        except Exception:
+            return
+        if value is not None:
+            yield name + format_labels(labels), value
+
+
+class Histogram:
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self, name: str, labels):
+        with self.lock:
+            counts = list(self.counts)
+            count, total = self.count, self.sum
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'), ), counts):
+            cumulative += n
+            yield (name + '_bucket' +
+                   format_labels(labels, ('le', format_value(bound))),
+                   cumulative)
+        yield name + '_sum' + format_labels(labels), total
+        yield name + '_count' + format_labels(labels), count
+
+
+class Registry:
+    '''Metric families by name, each with one child per label set.
+
+    render() gives the Prometheus text exposition format.
+    '''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.families: dict[str, tuple[str, str, dict]] = {}
+
+    def child(self, kind: str, name: str, help: str, labels: dict[str, str],
+              factory: Callable):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = (kind, help, {})
+                self.families[name] = family
+            children = family[2]
+            metric = children.get(key)
+            if metric is None:
+                metric = factory()
+                children[key] = metric
+            return metric
+
+    def counter(self, name: str, help: str = '', **labels) -> Counter:
+        return self.child('counter', name, help, labels, Counter)
+
+    def histogram(self,
+                  name: str,
+                  help: str = '',
+                  buckets: tuple[float, ...] = LATENCY_BUCKETS,
+                  **labels) -> Histogram:
+        return self.child('histogram', name, help, labels,
+                          lambda: Histogram(buckets))
+
+    def gauge(self, name: str, func: Callable[[], float], help: str = '',
+              **labels) -> Gauge:
+        gauge = self.child('gauge', name, help, labels, lambda: Gauge(func))
+        gauge.func = func
+        return gauge
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            families = [(name, kind, help, list(children.items()))
+                        for name, (kind, help,
+                                   children) in self.families.items()]
+        for name, kind, help, children in families:
+            if help:
+                lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, metric in children:
+                for sample, value in metric.samples(name, labels):
+                    lines.append(f'{sample} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def stage_histogram(stage: str) -> Histogram:
+    return REGISTRY.histogram('sekai_stage_seconds',
+                              'Time spent in each pipeline stage',
+                              stage=stage)
+
+
+def observe_stage(stage: str, seconds: float):
+    stage_histogram(stage).observe(seconds)
@@ -0,0 +1,110 @@
+import pickle
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+from utils import DiamondPlace, HarvestMapTable
+
+ROLES = ['standalone', 'writer', 'reader']
+STATE_PATH = 'data/sekai_state.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS user_state (
+    user_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    map_update REAL NOT NULL,
+    harvest_map BLOB NOT NULL,
+    current_ids BLOB NOT NULL,
+    diamond_update REAL NOT NULL,
+    diamonds BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS user_state_seq ON user_state (seq);
+'''
+
+
+@dataclass(slots=True)
+class UserState:
+    user_id: str
+    map_update: float
+    harvest_map: HarvestMapTable
+    current_ids: dict[str, set[int]]
+    diamond_update: float
+    diamonds: list[DiamondPlace] = field(default_factory=list)
+
+
+class SharedState:
+    '''Latest harvest state per user in a SQLite database in WAL mode.
+
+    One webapp process consumes packets and writes, any number of webapp
+    processes read. Every write stamps the row with a global sequence
+    number, so readers fetch only rows newer than what they have seen.
+    PRAGMA data_version tells them cheaply whether anything changed at all.
+    '''
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = Path(path or STATE_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Called from nicegui io_bound threads, one at a time.
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path,
+                                    timeout=5,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.seq = 0
+        self.data_version: Optional[int] = None
+
+    def write(self, states: list[UserState]):
+        if not states:
+            return
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                (seq, ) = self.conn.execute(
+                    'SELECT COALESCE(MAX(seq), 0) FROM user_state').fetchone()
+                for state in states:
+                    seq += 1
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO user_state VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?)', (
+                            state.user_id,
+                            seq,
+                            state.map_update,
+                            pickle.dumps(state.harvest_map),
+                            pickle.dumps(state.current_ids),
+                            state.diamond_update,
+                            pickle.dumps(state.diamonds),
+                        ))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.seq = seq
+
+    def read_changes(self) -> list[UserState]:
+        with self.lock:
+            (version, ) = self.conn.execute(
+                'PRAGMA data_version').fetchone()
+            if version == self.data_version:
+                return []
+            self.data_version = version
+            rows = self.conn.execute(
+                'SELECT * FROM user_state WHERE seq > ? ORDER BY seq',
+                (self.seq, )).fetchall()
+        states = []
+        for (user_id, seq, map_update, harvest_map, current_ids,
+             diamond_update, diamonds) in rows:
+            self.seq = max(self.seq, seq)
+            states.append(
+                UserState(user_id, map_update, pickle.loads(harvest_map),
+                          pickle.loads(current_ids), diamond_update,
+                          pickle.loads(diamonds)))
+        return states
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,243 @@
+import argparse
+import asyncio
+import json
+import mmap
+import os
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from queue import Queue, Full
+from typing import Iterator, Optional
+
+from utils import SekaiTool, NetworkPackage
+
+SPOOL_DIR = 'sekai_data'
+WRITER_QUEUE_SIZE = 64
+
+
+@dataclass(slots=True)
+class SpoolRecord:
+    url: str
+    user: Optional[str]
+    ts: float
+    offset: int
+    length: int
+
+
+class SpoolWriter:
+    '''Append-only packet spool written from a background thread.
+
+    Payloads go back to back into <name>.dat, and every payload gets one
+    JSON line in <name>.idx with its URL, user, capture time, offset and
+    length. The index line is written after its payload is flushed, so a
+    crash never leaves an index entry without data. Each process writes
+    its own pair of files.
+    '''
+
+    def __init__(self, spool_dir: str = SPOOL_DIR) -> None:
+        name = datetime.now().strftime(f'spool_%Y%m%d_%H%M%S_{os.getpid()}')
+        directory = Path(spool_dir)
+        directory.mkdir(parents=True, exist_ok=True)
+        self.data_path = directory / f'{name}.dat'
+        self.index_path = directory / f'{name}.idx'
+        self.queue: Queue = Queue(WRITER_QUEUE_SIZE)
+        self.written = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.thread.start()
+
+    def append(self, url: str, data: bytes, ts: Optional[float] = None):
+        # Never blocks the caller, the packet is dropped if the disk falls
+        # behind.
+        try:
+            self.queue.put_nowait((url, data, ts or time.time()))
+        except Full:
+            self.dropped += 1
+            print('Spool writer busy, skip packet')
+
+    def writer_loop(self):
+        with open(self.data_path, 'ab') as data_file, \
+                open(self.index_path, 'a') as index_file:
+            offset = data_file.tell()
+            while True:
+                url, data, ts = self.queue.get()
+                try:
+                    data_file.write(data)
+                    data_file.flush()
+                    record = {
+                        'url': url,
+                        'user': SekaiTool.extract_user_id(url),
+                        'ts': ts,
+                        'offset': offset,
+                        'length': len(data),
+                    }
+                    index_file.write(json.dumps(record) + '\n')
+                    index_file.flush()
+                    offset += len(data)
+                    self.written += 1
+                except Exception as ex:
+                    print('Error on save packet:', type(ex), ex)
+                    offset = data_file.tell()
+
+
+class SpoolReader:
+
+    def __init__(self, index_path: str) -> None:
+        self.index_path = Path(index_path)
+        self.data_path = self.index_path.with_suffix('.dat')
+
+    def records(self) -> list[SpoolRecord]:
+        records = []
+        with open(self.index_path) as f:
+            for line in f:
+                # A torn last line from a crash is ignored.
+                try:
+                    records.append(SpoolRecord(**json.loads(line)))
+                except (ValueError, TypeError):
+                    continue
+        return records
+
+    @contextmanager
+    def mapped(self) -> Iterator[mmap.mmap]:
+        with open(self.data_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+    def packages(self) -> Iterator[tuple[SpoolRecord, NetworkPackage]]:
+        records = self.records()
+        if not records:
+            return
+        with self.mapped() as mapped:
+            for record in records:
+                data = mapped[record.offset:record.offset + record.length]
+                yield record, NetworkPackage(record.url, data)
+
+
+def replay_packages(index_paths: list[str], loop: int, users: int):
+    # Only the records of all spools are merged in capture order, each
+    # payload is copied out of its spool's mapping when it is sent. With
+    # users > 1 the packets are spread over fake user ids so they are not
+    # coalesced.
+    with ExitStack() as stack:
+        items: list[tuple[SpoolRecord, mmap.mmap]] = []
+        for path in index_paths:
+            reader = SpoolReader(path)
+            records = reader.records()
+            if records:
+                mapped = stack.enter_context(reader.mapped())
+                items.extend((record, mapped) for record in records)
+        items.sort(key=lambda item: item[0].ts)
+        count = 0
+        for _ in range(loop):
+            for record, mapped in items:
+                url = record.url
+                if users > 1 and record.user:
+                    fake = f'{record.user}{count % users:04d}'
+                    url = url.replace(f'/user/{record.user}/',
+                                      f'/user/{fake}/')
+                count += 1
+                data = mapped[record.offset:record.offset + record.length]
+                yield record, NetworkPackage(url, data)
+
+
+class ReplayClock:
+
+    def __init__(self, speed: float) -> None:
+        # speed 1 is recorded speed, 0 is as fast as possible.
+        self.speed = speed
+        self.start: Optional[float] = None
+        self.first_ts = 0.0
+        self.last_ts = 0.0
+
+    def delay(self, ts: float) -> float:
+        if self.speed <= 0:
+            return 0
+        # Time going backwards means the next loop over the spool started.
+        if self.start is None or ts < self.last_ts:
+            self.start = time.monotonic()
+            self.first_ts = ts
+        self.last_ts = ts
+        due = self.start + (ts - self.first_ts) / self.speed
+        return max(due - time.monotonic(), 0)
+
+
+def replay_to_manager(args) -> int:
+    from manager import QueueManager
+    manager = QueueManager(address=('', 50000), authkey=b'abracadabra')
+    manager.connect()
+    q = manager.get_queue()
+    clock = ReplayClock(args.speed)
+    sent = 0
+    for record, pack in replay_packages(args.index, args.loop, args.users):
+        time.sleep(clock.delay(record.ts))
+        q.put(pack)
+        sent += 1
+    return sent
+
+
+async def replay_to_broker(args) -> int:
+    from broker import BrokerProducer
+    producer = await BrokerProducer.connect(args.broker)
+    clock = ReplayClock(args.speed)
+    sent = 0
+    try:
+        for record, pack in replay_packages(args.index, args.loop,
+                                            args.users):
+            await asyncio.sleep(clock.delay(record.ts))
+            await producer.put([pack])
+            sent += 1
+    finally:
+        await producer.close()
+    return sent
+
+
+def show_info(args):
+    for path in args.index:
+        records = SpoolReader(path).records()
+        users = {r.user for r in records}
+        size = sum(r.length for r in records)
+        span = records[-1].ts - records[0].ts if records else 0
+        print(f'{path}: {len(records)} packets, {len(users)} users, '
+              f'{size} bytes, {span:.1f}s')
+
+
+def main():
+    from broker import BROKER_ADDRESS
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    info = sub.add_parser('info', help='summarise spool files')
+    info.add_argument('index', nargs='+')
+    replay = sub.add_parser('replay', help='feed spool files to the webapp')
+    replay.add_argument('index', nargs='+')
+    replay.add_argument('--hub', choices=['manager', 'broker'],
+                        default=os.environ.get('SEKAI_HUB', 'manager'))
+    replay.add_argument('--broker', default=BROKER_ADDRESS)
+    replay.add_argument('--speed',
+                        type=float,
+                        default=1,
+                        help='1 is recorded speed, 0 as fast as possible')
+    replay.add_argument('--loop', type=int, default=1)
+    replay.add_argument('--users',
+                        type=int,
+                        default=1,
+                        help='spread packets over this many fake users')
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        show_info(args)
+        return
+    start = time.perf_counter()
+    if args.hub == 'broker':
+        sent = asyncio.run(replay_to_broker(args))
+    else:
+        sent = replay_to_manager(args)
+    elapsed = time.perf_counter() - start
+    print(f'Replayed {sent} packets in {elapsed:.2f}s '
+          f'({sent / elapsed if elapsed else 0:.1f}/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import random
+from typing import Any
+
+import msgpack
+from sssekai.crypto.APIManager import encrypt, SEKAI_APIMANAGER_KEYSETS
+
+from utils import NetworkPackage, PLACE_NAME, FIXTURE_NAME
+
+KEYSET = SEKAI_APIMANAGER_KEYSETS['jp']
+# Outdoor sites that have harvest maps, the others are rooms of the house.
+HARVEST_SITES = [int(site) for site in PLACE_NAME if int(site) >= 5]
+FIXTURE_IDS = [int(fixture) for fixture in FIXTURE_NAME]
+# What each fixture family drops, by the thousands digit of its id:
+# (resource_type, resource_id, weight). Rare drops are spawn limited.
+FIXTURE_DROPS = {
+    1: [('mysekai_material', 1, 6), ('mysekai_material', 2, 4),
+        ('mysekai_material', 3, 4), ('mysekai_material', 4, 2),
+        ('mysekai_material', 5, 1)],
+    2: [('mysekai_material', 6, 6), ('mysekai_material', 7, 4),
+        ('mysekai_material', 8, 3), ('mysekai_material', 9, 3),
+        ('mysekai_material', 10, 2), ('mysekai_material', 11, 2),
+        ('mysekai_material', 12, 0.3)],
+    3: [('mysekai_material', 13, 3), ('mysekai_material', 14, 3),
+        ('mysekai_material', 15, 2), ('mysekai_material', 16, 1),
+        ('mysekai_material', 17, 1), ('mysekai_material', 18, 1),
+        ('mysekai_material', 19, 1)],
+    4: [('mysekai_material', 21, 4), ('mysekai_material', 22, 4),
+        ('mysekai_material', 23, 6), ('mysekai_material', 20, 0.3)],
+    5: [('mysekai_material', 32, 2), ('mysekai_material', 33, 1),
+        ('mysekai_material', 34, 0.5)],
+    6: [('mysekai_item', 7, 2), ('material', 17, 1), ('material', 57, 1)],
+}
+# Loose drops lying on the ground without a fixture.
+GROUND_DROPS = [('mysekai_material', 23, 3), ('mysekai_item', 7, 1),
+                ('material', 17, 1)]
+RARE_WEIGHT = 0.5
+SPAWN_LIMIT_GROUPS = [2501, 2502, 2503, 2504]
+GRID = 40
+
+
+def weighted_choice(rng: random.Random, choices: list[tuple[str, int,
+                                                            float]]):
+    return rng.choices(choices, weights=[c[2] for c in choices])[0]
+
+
+def make_site(rng: random.Random, site_id: int, drops: int,
+              fixtures: int) -> dict[str, Any]:
+    cells = rng.sample(range(GRID * GRID), min(fixtures, GRID * GRID))
+    site_fixtures = []
+    for cell in cells:
+        site_fixtures.append({
+            'mysekaiSiteHarvestFixtureId': rng.choice(FIXTURE_IDS),
+            'positionX': cell % GRID - GRID // 2,
+            'positionZ': cell // GRID - GRID // 2,
+            'hp': rng.choice([100, 200, 300]),
+            'userMysekaiSiteHarvestFixtureStatus': 'spawned',
+        })
+
+    site_drops = []
+    for seq in range(drops):
+        # Most drops sit on a fixture and come from its family.
+        if site_fixtures and rng.random() < 0.9:
+            fixture = rng.choice(site_fixtures)
+            family = fixture['mysekaiSiteHarvestFixtureId'] // 1000
+            res_type, res_id, weight = weighted_choice(
+                rng, FIXTURE_DROPS.get(family, GROUND_DROPS))
+            pos_x, pos_z = fixture['positionX'], fixture['positionZ']
+        else:
+            res_type, res_id, weight = weighted_choice(rng, GROUND_DROPS)
+            cell = rng.randrange(GRID * GRID)
+            pos_x, pos_z = cell % GRID - GRID // 2, cell // GRID - GRID // 2
+        drop = {
+            'resourceType': res_type,
+            'resourceId': res_id,
+            'positionX': pos_x,
+            'positionZ': pos_z,
+            'hp': rng.choice([10, 20, 30]),
+            'seq': seq,
+            'mysekaiSiteHarvestResourceDropStatus': 'before_drop',
+            'quantity': rng.randint(1, 3) if weight > RARE_WEIGHT else 1,
+        }
+        if weight <= RARE_WEIGHT:
+            drop['mysekaiSiteHarvestSpawnLimitedRelationGroupId'] = (
+                rng.choice(SPAWN_LIMIT_GROUPS))
+        site_drops.append(drop)
+
+    return {
+        'mysekaiSiteId': site_id,
+        'userMysekaiSiteHarvestFixtures': site_fixtures,
+        'userMysekaiSiteHarvestResourceDrops': site_drops,
+    }
+
+
+def make_harvest_maps(sites: int = 4,
+                      drops: int = 200,
+                      fixtures: int = 100,
+                      seed: int = 0) -> list[dict[str, Any]]:
+    # userMysekaiHarvestMaps with sites sites, taken from the harvest sites
+    # first, each with fixtures fixtures and drops drops.
+    rng = random.Random(seed)
+    site_ids = HARVEST_SITES + list(
+        range(max(HARVEST_SITES) + 1,
+              max(HARVEST_SITES) + 1 + max(sites - len(HARVEST_SITES), 0)))
+    return [
+        make_site(rng, site_id, drops, fixtures)
+        for site_id in site_ids[:sites]
+    ]
+
+
+def make_response(harvest_maps: list[dict[str, Any]],
+                  extra_records: int = 0,
+                  seed: int = 0) -> dict[str, Any]:
+    # A mysekai reload response. extra_records pads it with material
+    # records, the bulk of a real response that is not harvest maps.
+    rng = random.Random(seed)
+    materials = [{
+        'mysekaiMaterialId': i % 66 + 1,
+        'quantity': rng.randint(0, 999),
+        'obtainedAt': 1700000000000 + i,
+    } for i in range(extra_records)]
+    return {
+        'updatedResources': {
+            'userMysekaiHarvestMaps': harvest_maps,
+            'userMysekaiMaterials': materials,
+        },
+        'now': 1700000000000,
+    }
+
+
+def make_url(user_id: str) -> str:
+    return ('https://production-game-api.sekai.colorfulpalette.org/api/user/'
+            f'{user_id}/mysekai?isForceAllReloadOnlyMysekai=True')
+
+
+def encrypt_response(response: dict[str, Any]) -> bytes:
+    # Encrypted with the keyset SekaiTool.decrypt_data expects.
+    return encrypt(msgpack.packb(response), KEYSET)
+
+
+def make_packet(user_id: str,
+                harvest_maps: list[dict[str, Any]],
+                extra_records: int = 0) -> NetworkPackage:
+    response = make_response(harvest_maps, extra_records)
+    return NetworkPackage(make_url(user_id), encrypt_response(response))
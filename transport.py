@@ -0,0 +1,86 @@
+import mmap
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from utils import SekaiTool, NetworkPackage, PacketResult
+
+TRANSPORTS = ['queue', 'shm']
+DEFAULT_SPOOL_DIR = '/dev/shm/sekai_spool'
+
+
+@dataclass(slots=True)
+class SpoolPackage:
+    # Descriptor of a NetworkPackage whose payload was written to the spool.
+    # Only this travels through the manager queue.
+    url: str
+    path: str
+    length: int
+    captured: float = 0.0
+
+
+class ShmSpool:
+    '''Payload spool on a tmpfs directory shared by the local processes.
+
+    The writer stores each payload in its own file and hands out a
+    SpoolPackage. The reader maps the file, decodes straight from the
+    mapping and removes it, so the payload bytes are never pickled.
+    '''
+
+    def __init__(self, spool_dir: Optional[str] = None) -> None:
+        self.spool_dir = Path(spool_dir or DEFAULT_SPOOL_DIR)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+
+    def store(self, pack: NetworkPackage) -> SpoolPackage:
+        path = self.spool_dir / f'{os.getpid()}_{uuid.uuid4().hex}.bin'
+        # The descriptor is only published after the write completes, so
+        # readers never see a partial file.
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            with memoryview(pack.data) as view:
+                written = 0
+                while written < len(view):
+                    written += os.write(fd, view[written:])
+        except BaseException:
+            os.close(fd)
+            path.unlink(missing_ok=True)
+            raise
+        os.close(fd)
+        return SpoolPackage(pack.url, str(path), len(pack.data),
+                            pack.captured)
+
+    def cleanup(self, max_age: float) -> int:
+        # Remove payloads whose descriptor was lost, e.g. dropped on a full
+        # queue or left behind by a crashed consumer.
+        deadline = time.time() - max_age
+        removed = 0
+        for path in self.spool_dir.glob('*.bin'):
+            try:
+                if path.stat().st_mtime < deadline:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+
+def discard(ref: SpoolPackage):
+    Path(ref.path).unlink(missing_ok=True)
+
+
+def process_spooled(ref: SpoolPackage) -> Optional[PacketResult]:
+    try:
+        with open(ref.path, 'rb') as f:
+            if ref.length == 0:
+                return SekaiTool.process_package(
+                    NetworkPackage(ref.url, b'', ref.captured))
+            with mmap.mmap(f.fileno(), ref.length,
+                           access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    return SekaiTool.process_package(
+                        NetworkPackage(ref.url, view, ref.captured))
+    finally:
+        discard(ref)
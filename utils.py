@@ -1,11 +1,19 @@
-from typing import Any, Optional, NamedTuple
+from typing import Any, Iterable, Optional, NamedTuple
 import json
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import re
 from requests import Session
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import itertools
-
-from sssekai.crypto.APIManager import decrypt, SEKAI_APIMANAGER_KEYSETS
+import threading
+import time
+from pathlib import Path
+from array import array
+from bisect import bisect_right
+
+from sssekai.crypto.APIManager import SEKAI_APIMANAGER_KEYSETS
+from Crypto.Cipher import AES
 import msgpack
 
 RESOURCE_NAMES = {
@@ -112,7 +120,14 @@ FIXTURE_NAME = {
 }
 
 
-@dataclass
+# Key paths extract_harvest_map can read the harvest maps from.
+HARVEST_MAP_PATHS = [
+    ('updatedResources', 'userMysekaiHarvestMaps'),
+    ('userMysekaiHarvestMaps', ),
+]
+
+
+@dataclass(slots=True)
 class DiamondPlace:
     site_id: int
     drop: dict
@@ -122,9 +137,29 @@ class DiamondPlace:
 class NetworkPackage:
     url: str
     data: bytes
+    # Wall clock time the addon captured the response, 0 if unknown.
+    captured: float = 0.0
+
+
+@dataclass
+class HarvestPackage:
+    url: str
+    harvest_maps: Optional[list[dict[str, Any]]]
+    captured: float = 0.0
 
 
 @dataclass
+class PacketResult:
+    url: str
+    harvest_maps: 'HarvestMapTable'
+    harvest_count: list[dict[str, int]]
+    diamonds: list[DiamondPlace]
+    current_ids: dict[str, set[int]]
+    # Seconds per stage, measured where the packet was processed.
+    timings: dict[str, float] = field(default_factory=dict)
+
+
+@dataclass(slots=True)
 class OtherItems:
     resouce_name: str
     quantity: int
@@ -139,7 +174,7 @@ class ResourceIndex(NamedTuple):
     spawn_limit: Optional[int]
 
 
-@dataclass
+@dataclass(slots=True)
 class ResourcePlace:
     resource_name: str
     place_name: str
@@ -150,6 +185,175 @@ class ResourcePlace:
     fixture_name: str
     fixture_all_items: list[OtherItems]
     raw_data: list[DiamondPlace]
+    index: Optional[ResourceIndex] = None
+
+
+class HarvestMapTable:
+    RESOURCE_TYPES = [
+        'mysekai_material',
+        'mysekai_item',
+        'material',
+        'mysekai_fixture',
+    ]
+    NO_LIMIT = -1
+
+    def __init__(self) -> None:
+        # Sites are stored in map order, the drops and fixtures of site i
+        # are the rows offsets[i]:offsets[i + 1] of the columns below.
+        self.sites = array('i')
+        self.drop_offsets = array('i', [0])
+        self.fixture_offsets = array('i', [0])
+        self.resource_types = list(self.RESOURCE_TYPES)
+
+        self.drop_type = array('b')
+        self.drop_id = array('i')
+        self.drop_x = array('i')
+        self.drop_z = array('i')
+        self.drop_quantity = array('i')
+        self.drop_limit = array('i')
+
+        self.fixture_id = array('i')
+        self.fixture_x = array('i')
+        self.fixture_z = array('i')
+
+    @classmethod
+    def from_harvest_maps(cls, harvest_maps: list[dict[str, Any]]):
+        table = cls()
+        type_codes = {t: i for i, t in enumerate(table.resource_types)}
+        for harvest_map in harvest_maps:
+            table.sites.append(harvest_map['mysekaiSiteId'])
+            drops: list[dict[str, Any]] = (
+                harvest_map['userMysekaiSiteHarvestResourceDrops'])
+            fixtures: list[dict[str, Any]] = (
+                harvest_map['userMysekaiSiteHarvestFixtures'])
+
+            for drop in drops:
+                res_type = drop['resourceType']
+                if res_type not in type_codes:
+                    type_codes[res_type] = len(table.resource_types)
+                    table.resource_types.append(res_type)
+                limit = drop.get(
+                    'mysekaiSiteHarvestSpawnLimitedRelationGroupId')
+                table.drop_type.append(type_codes[res_type])
+                table.drop_id.append(drop['resourceId'])
+                table.drop_x.append(drop['positionX'])
+                table.drop_z.append(drop['positionZ'])
+                table.drop_quantity.append(drop['quantity'])
+                if limit is None:
+                    limit = cls.NO_LIMIT
+                table.drop_limit.append(limit)
+
+            for fixture in fixtures:
+                table.fixture_id.append(fixture['mysekaiSiteHarvestFixtureId'])
+                table.fixture_x.append(fixture['positionX'])
+                table.fixture_z.append(fixture['positionZ'])
+
+            table.drop_offsets.append(len(table.drop_id))
+            table.fixture_offsets.append(len(table.fixture_id))
+        return table
+
+    @classmethod
+    def of(cls, harvest_maps: 'list[dict[str, Any]] | HarvestMapTable'):
+        if isinstance(harvest_maps, HarvestMapTable):
+            return harvest_maps
+        return cls.from_harvest_maps(harvest_maps)
+
+    def __len__(self):
+        return len(self.drop_id)
+
+    def type_code(self, resource_type: str) -> Optional[int]:
+        if resource_type in self.resource_types:
+            return self.resource_types.index(resource_type)
+        return None
+
+    def site_drops(self, site: int):
+        return range(self.drop_offsets[site], self.drop_offsets[site + 1])
+
+    def site_fixtures(self, site: int):
+        return range(self.fixture_offsets[site],
+                     self.fixture_offsets[site + 1])
+
+    def find_drop_rows(self, resource_id: int,
+                       resource_type: Optional[str] = None):
+        if resource_type is None:
+            return [i for i, rid in enumerate(self.drop_id)
+                    if rid == resource_id]
+        code = self.type_code(resource_type)
+        return [
+            i for i, (t, rid) in enumerate(zip(self.drop_type, self.drop_id))
+            if rid == resource_id and t == code
+        ]
+
+    def row_site(self, row: int):
+        return bisect_right(self.drop_offsets, row) - 1
+
+    def drop_spawn_limit(self, row: int) -> Optional[int]:
+        limit = self.drop_limit[row]
+        return None if limit == self.NO_LIMIT else limit
+
+    def drop(self, row: int) -> dict[str, Any]:
+        ret = {
+            'resourceType': self.resource_types[self.drop_type[row]],
+            'resourceId': self.drop_id[row],
+            'positionX': self.drop_x[row],
+            'positionZ': self.drop_z[row],
+            'quantity': self.drop_quantity[row],
+        }
+        limit = self.drop_spawn_limit(row)
+        if limit is not None:
+            ret['mysekaiSiteHarvestSpawnLimitedRelationGroupId'] = limit
+        return ret
+
+
+class SiteIndex:
+
+    def __init__(self, table: HarvestMapTable, site: int) -> None:
+        self.table = table
+        self.site_id: int = table.sites[site]
+
+        self.fixtures: dict[tuple[int, int], int] = {}
+        for row in table.site_fixtures(site):
+            pos = (table.fixture_x[row], table.fixture_z[row])
+            self.fixtures.setdefault(pos, table.fixture_id[row])
+
+        self.drops: dict[tuple[int, int], list[int]] = {}
+        self.resources: dict[tuple[str, int], list[int]] = {}
+        types = table.resource_types
+        for row in table.site_drops(site):
+            pos = (table.drop_x[row], table.drop_z[row])
+            self.drops.setdefault(pos, []).append(row)
+            res = (types[table.drop_type[row]], table.drop_id[row])
+            self.resources.setdefault(res, []).append(row)
+
+        # Filled by SekaiTool.extract_site_resources, every resource at a
+        # position shares the same summary of the items there.
+        self.summaries: dict[tuple[int, int], list[OtherItems]] = {}
+
+    def find_fixture(self, pos_x: int, pos_z: int) -> Optional[int]:
+        return self.fixtures.get((pos_x, pos_z))
+
+    def drops_at_position(self, pos_x: int, pos_z: int):
+        return self.drops.get((pos_x, pos_z), [])
+
+    def find_drops(self, resource_type: str, resource_id: int):
+        return self.resources.get((resource_type, resource_id), [])
+
+
+@dataclass
+class NameTables:
+    mysekai_materials: dict[int, str] = field(default_factory=dict)
+    mysekai_materials_tc: dict[int, str] = field(default_factory=dict)
+    mysekai_items: dict[int, str] = field(default_factory=dict)
+    mysekai_items_tc: dict[int, str] = field(default_factory=dict)
+    materials: dict[int, str] = field(default_factory=dict)
+    materials_tc: dict[int, str] = field(default_factory=dict)
+    mysekai_fixtures: dict[int, str] = field(default_factory=dict)
+    mysekai_fixtures_tc: dict[int, str] = field(default_factory=dict)
+
+    mysekai_materials_combine: dict[int, str] = field(default_factory=dict)
+    mysekai_items_combine: dict[int, str] = field(default_factory=dict)
+    materials_combine: dict[int, str] = field(default_factory=dict)
+    mysekai_fixtures_combine: dict[int, str] = field(default_factory=dict)
 
 
 class SekaiResources:
@@ -159,21 +363,40 @@ class SekaiResources:
     REPO_TC = 'sekai-master-db-tc-diff'
 
     URL = 'https://raw.githubusercontent.com/Sekai-World/{repo}/refs/heads/main/{file}'
-
-    def __init__(self) -> None:
-        self.mysekai_materials: dict[int, str] = {}
-        self.mysekai_materials_tc: dict[int, str] = {}
-        self.mysekai_items: dict[int, str] = {}
-        self.mysekai_items_tc: dict[int, str] = {}
-        self.materials: dict[int, str] = {}
-        self.materials_tc: dict[int, str] = {}
-        self.mysekai_fixtures: dict[int, str] = {}
-        self.mysekai_fixtures_tc: dict[int, str] = {}
-
-        self.mysekai_materials_combine: dict[int, str] = {}
-        self.mysekai_items_combine: dict[int, str] = {}
-        self.materials_combine: dict[int, str] = {}
-        self.mysekai_fixtures_combine: dict[int, str] = {}
+    CACHE_PATH = 'data/sekai_resources.json'
+
+    FILES = [
+        ('mysekaiMaterials.json', REPO_JP, 'mysekai_materials'),
+        ('mysekaiMaterials.json', REPO_TC, 'mysekai_materials_tc'),
+        ('mysekaiItems.json', REPO_JP, 'mysekai_items'),
+        ('mysekaiItems.json', REPO_TC, 'mysekai_items_tc'),
+        ('materials.json', REPO_JP, 'materials'),
+        ('materials.json', REPO_TC, 'materials_tc'),
+        ('mysekaiFixtures.json', REPO_JP, 'mysekai_fixtures'),
+        ('mysekaiFixtures.json', REPO_TC, 'mysekai_fixtures_tc'),
+    ]
+
+    COMBINES = [
+        ('mysekai_materials_combine', 'mysekai_materials',
+         'mysekai_materials_tc'),
+        ('mysekai_items_combine', 'mysekai_items', 'mysekai_items_tc'),
+        ('materials_combine', 'materials', 'materials_tc'),
+        ('mysekai_fixtures_combine', 'mysekai_fixtures',
+         'mysekai_fixtures_tc'),
+    ]
+
+    def __init__(self,
+                 url: Optional[str] = None,
+                 cache_path: Optional[str] = None) -> None:
+        # url is a template with {repo} and {file}, either an http(s) URL or
+        # a local path such as 'fixtures/{repo}/{file}'.
+        self.url = url or self.URL
+        self.cache_path = Path(cache_path or self.CACHE_PATH)
+        self.file_meta: dict[str, dict[str, Any]] = {}
+        # Readers always go through self.tables, refreshes build a complete
+        # new NameTables and publish it with a single assignment.
+        self.tables = NameTables()
+        self.version = 0
 
     @classmethod
     def instance(cls):
@@ -182,67 +405,115 @@ class SekaiResources:
         return cls.INSTANCE
 
     def update(self):
-        sess = Session()
-
-        file_repos = [
-            ('mysekaiMaterials.json', self.REPO_JP),
-            ('mysekaiMaterials.json', self.REPO_TC),
-            ('mysekaiItems.json', self.REPO_JP),
-            ('mysekaiItems.json', self.REPO_TC),
-            ('materials.json', self.REPO_JP),
-            ('materials.json', self.REPO_TC),
-            ('mysekaiFixtures.json', self.REPO_JP),
-            ('mysekaiFixtures.json', self.REPO_TC),
-        ]
-
-        mappings = [
-            self.mysekai_materials,
-            self.mysekai_materials_tc,
-            self.mysekai_items,
-            self.mysekai_items_tc,
-            self.materials,
-            self.materials_tc,
-            self.mysekai_fixtures,
-            self.mysekai_fixtures_tc,
-        ]
-
-        for (f, r), d in zip(file_repos, mappings):
-            url = self.URL.format(repo=r, file=f)
-            ret = sess.get(url)
-            if ret.ok:
-                data = ret.content
-                json_data = json.loads(data)
-                extracted = {int(o['id']): str(o['name']) for o in json_data}
-                d.clear()
-                d.update(extracted)
-
-        combines = [
-            (
-                self.mysekai_materials_combine,
-                self.mysekai_materials,
-                self.mysekai_materials_tc,
-            ),
-            (
-                self.mysekai_items_combine,
-                self.mysekai_items,
-                self.mysekai_items_tc,
-            ),
-            (self.materials_combine, self.materials, self.materials_tc),
-            (
-                self.mysekai_fixtures_combine,
-                self.mysekai_fixtures,
-                self.mysekai_fixtures_tc,
-            ),
-        ]
-
-        for combine, jp, tc in combines:
-            combine.clear()
+        with Session() as sess, ThreadPoolExecutor(len(self.FILES)) as pool:
+            adapter = HTTPAdapter(pool_maxsize=len(self.FILES))
+            sess.mount('http://', adapter)
+            sess.mount('https://', adapter)
+            futures = [
+                pool.submit(self.fetch_names, sess, r, f)
+                for f, r, _ in self.FILES
+            ]
+            results = [future.result() for future in futures]
+
+        names = {name: getattr(self.tables, name) for _, _, name in self.FILES}
+        file_meta = dict(self.file_meta)
+        changed = False
+        for (f, r, name), ret in zip(self.FILES, results):
+            if ret is not None:
+                names[name], file_meta[f'{r}/{f}'] = ret
+                changed = True
+
+        if changed:
+            self.publish(names, file_meta)
+            self.save_cache()
+        return changed
+
+    def fetch_names(self, sess: Session, repo: str, file: str):
+        key = f'{repo}/{file}'
+        meta = self.file_meta.get(key, {})
+        url = self.url.format(repo=repo, file=file)
+        if url.startswith(('http://', 'https://')):
+            headers = {}
+            if 'etag' in meta:
+                headers['If-None-Match'] = meta['etag']
+            if 'last_modified' in meta:
+                headers['If-Modified-Since'] = meta['last_modified']
+            ret = sess.get(url, headers=headers)
+            if ret.status_code == 304 or not ret.ok:
+                return None
+            data = ret.content
+            new_meta = {}
+            if 'ETag' in ret.headers:
+                new_meta['etag'] = ret.headers['ETag']
+            if 'Last-Modified' in ret.headers:
+                new_meta['last_modified'] = ret.headers['Last-Modified']
+        else:
+            path = Path(url)
+            if not path.is_file():
+                return None
+            mtime = path.stat().st_mtime
+            if meta.get('mtime') == mtime:
+                return None
+            data = path.read_bytes()
+            new_meta = {'mtime': mtime}
+
+        json_data = json.loads(data)
+        names = {int(o['id']): str(o['name']) for o in json_data}
+        return names, new_meta
+
+    def publish(self, names: dict[str, dict[int, str]],
+                file_meta: dict[str, dict[str, Any]]):
+        tables = NameTables(**names)
+        for combine_name, jp_name, tc_name in self.COMBINES:
+            combine: dict[int, str] = getattr(tables, combine_name)
+            jp = names[jp_name]
+            tc = names[tc_name]
             for i in jp:
                 if i in tc:
                     combine[i] = f'{jp[i]}({tc[i]})'
                 else:
                     combine[i] = jp[i]
 
+        self.tables = tables
+        self.file_meta = file_meta
+        self.version += 1
+
+    def load_cache(self):
+        if not self.cache_path.is_file():
+            return False
+        cache = json.loads(self.cache_path.read_text(encoding='utf-8'))
+        files = cache.get('files', {})
+        names = {name: getattr(self.tables, name) for _, _, name in self.FILES}
+        file_meta = dict(self.file_meta)
+        for f, r, name in self.FILES:
+            key = f'{r}/{f}'
+            if key not in files:
+                continue
+            entry = files[key]
+            names[name] = {int(k): v for k, v in entry['names'].items()}
+            file_meta[key] = entry['meta']
+        self.publish(names, file_meta)
+        return True
+
+    def save_cache(self):
+        tables = self.tables
+        files = {}
+        for f, r, name in self.FILES:
+            key = f'{r}/{f}'
+            if key not in self.file_meta:
+                continue
+            files[key] = {
+                'meta': self.file_meta[key],
+                'names': getattr(tables, name),
+            }
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps({'files': files},
+                                       ensure_ascii=False,
+                                       separators=(',', ':')),
+                            encoding='utf-8')
+        tmp_path.replace(self.cache_path)
+
     def get_resource(self, resource_type: str, rid: int):
         match resource_type:
             case 'mysekai_material':
@@ -257,47 +528,68 @@ class SekaiResources:
                 raise RuntimeError(f'Invalid type {resource_type}')
 
     def get_mysekai_material(self, rid: int):
-        if rid in self.mysekai_materials_combine:
-            ret = self.mysekai_materials_combine[rid]
-        else:
+        ret = self.tables.mysekai_materials_combine.get(rid)
+        if ret is None:
             ret = f'MysekaiMaterial {rid}'
         return ret
 
     def get_all_mysekai_material(self):
-        return self.mysekai_materials_combine
+        return self.tables.mysekai_materials_combine
 
     def get_mysekai_item(self, rid: int):
-        if rid in self.mysekai_items_combine:
-            ret = self.mysekai_items_combine[rid]
-        else:
+        ret = self.tables.mysekai_items_combine.get(rid)
+        if ret is None:
             ret = f'MysekaiItem {rid}'
         return ret
 
     def get_all_mysekai_item(self):
-        return self.mysekai_items_combine
+        return self.tables.mysekai_items_combine
 
     def get_material(self, rid: int):
-        if rid in self.materials_combine:
-            ret = self.materials_combine[rid]
-        else:
+        ret = self.tables.materials_combine.get(rid)
+        if ret is None:
             ret = f'Material {rid}'
         return ret
 
     def get_all_material(self):
-        return self.materials_combine
+        return self.tables.materials_combine
 
     def get_mysekai_fixtures(self, rid: int):
-        if rid in self.mysekai_fixtures_combine:
-            ret = self.mysekai_fixtures_combine[rid]
-        else:
+        ret = self.tables.mysekai_fixtures_combine.get(rid)
+        if ret is None:
             ret = f'MysekaiFixture {rid}'
         return ret
 
     def get_all_mysekai_fixture(self):
-        return self.mysekai_fixtures_combine
+        return self.tables.mysekai_fixtures_combine
+
+
+class SekaiDecryptor:
+
+    def __init__(self, keyset: Optional[tuple[bytes, bytes]] = None):
+        if keyset is None:
+            keyset = SEKAI_APIMANAGER_KEYSETS['jp']
+        self.key, self.iv = keyset
+        self.buffer = bytearray()
+
+    def decrypt(self, data: bytes) -> memoryview:
+        # The returned view points into a buffer reused by the next call, so
+        # it has to be consumed (e.g. unpacked) before decrypting again.
+        size = len(data)
+        if size == 0 or size % AES.block_size:
+            raise ValueError(f'Invalid encrypted size {size}')
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        out = memoryview(self.buffer)[:size]
+        # CBC chains state through a message, a fresh cipher per packet only
+        # redoes the key schedule.
+        cipher = AES.new(self.key, AES.MODE_CBC, self.iv)
+        cipher.decrypt(data, output=out)
+        return out[:size - out[-1]]
 
 
 class SekaiTool:
+    LOCAL = threading.local()
 
     @staticmethod
     def all_resource_names():
@@ -315,52 +607,118 @@ class SekaiTool:
     def get_fixture_name(fix_id: int):
         return FIXTURE_NAME.get(str(fix_id), f'Fixture {fix_id}')
 
-    @staticmethod
-    def decrypt_data(data: bytes):
-        plain = decrypt(data, SEKAI_APIMANAGER_KEYSETS['jp'])
-        msg = msgpack.unpackb(plain)
+    @classmethod
+    def decrypt_data(cls,
+                     data: bytes,
+                     paths: Optional[Iterable[tuple[str, ...]]] = None):
+        plain = cls.decryptor().decrypt(data)
+        if paths is None:
+            msg = msgpack.unpackb(plain)
+        else:
+            msg = cls.unpack_paths(plain, paths)
         return msg
 
-    @staticmethod
-    def find_diamond(decrypted_data: dict,
-                     resource_id: int = 12) -> Optional[list[DiamondPlace]]:
-        root = decrypted_data
-        if 'updatedResources' in root:
-            root = root['updatedResources']
+    @classmethod
+    def decryptor(cls) -> SekaiDecryptor:
+        decryptor = getattr(cls.LOCAL, 'decryptor', None)
+        if decryptor is None:
+            decryptor = SekaiDecryptor()
+            cls.LOCAL.decryptor = decryptor
+        return decryptor
 
-        if 'userMysekaiHarvestMaps' in root:
-            harvest_maps = root['userMysekaiHarvestMaps']
-            ret = []
-            for harvest_map in harvest_maps:
-                site_id = harvest_map['mysekaiSiteId']
-                resource_drops = harvest_map[
-                    'userMysekaiSiteHarvestResourceDrops']
-                find_drop = [
-                    drop for drop in resource_drops
-                    if drop['resourceId'] == resource_id
-                ]
-                for drop in find_drop:
-                    ret.append(DiamondPlace(site_id, drop))
-            return ret
-        return None
+    @classmethod
+    def unpack_paths(cls, plain: bytes | memoryview,
+                     paths: Iterable[tuple[str, ...]]):
+        # Only materialise the values under the given key paths, everything
+        # else is skipped by the streaming unpacker. Maps on the way to a
+        # path are kept with just the selected keys.
+        tree: dict[str, Any] = {}
+        for path in paths:
+            node = tree
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+            node[path[-1]] = None
+
+        unpacker = msgpack.Unpacker(max_buffer_size=max(len(plain), 1))
+        unpacker.feed(plain)
+        try:
+            return cls.unpack_selected(unpacker, tree)
+        except ValueError:
+            return msgpack.unpackb(plain)
+
+    @classmethod
+    def unpack_selected(cls, unpacker: msgpack.Unpacker,
+                        tree: dict[str, Any]):
+        ret = {}
+        for _ in range(unpacker.read_map_header()):
+            key = unpacker.unpack()
+            if not isinstance(key, str) or key not in tree:
+                unpacker.skip()
+            elif tree[key] is None:
+                ret[key] = unpacker.unpack()
+            else:
+                try:
+                    ret[key] = cls.unpack_selected(unpacker, tree[key])
+                except ValueError:
+                    ret[key] = unpacker.unpack()
+        return ret
+
+    @classmethod
+    def find_diamond(cls,
+                     decrypted_data: dict,
+                     resource_id: int = 12) -> Optional[list[DiamondPlace]]:
+        harvest_maps = cls.extract_harvest_map(decrypted_data)
+        if harvest_maps is None:
+            return None
+        return cls.find_diamond_in_maps(harvest_maps, resource_id)
 
     @staticmethod
-    def get_remain_harvest_count(decrypted_data: dict):
-        root = decrypted_data
-        if 'updatedResources' in root:
-            root = root['updatedResources']
+    def find_diamond_in_maps(harvest_maps: list[dict[str, Any]]
+                             | HarvestMapTable,
+                             resource_id: int = 12) -> list[DiamondPlace]:
+        if isinstance(harvest_maps, HarvestMapTable):
+            table = harvest_maps
+            return [
+                DiamondPlace(table.sites[table.row_site(row)], table.drop(row))
+                for row in table.find_drop_rows(resource_id)
+            ]
 
-        if 'userMysekaiHarvestMaps' in root:
-            harvest_maps = root['userMysekaiHarvestMaps']
-            ret = []
-            for harvest_map in harvest_maps:
-                site_id = harvest_map['mysekaiSiteId']
-                resource_drops = harvest_map[
-                    'userMysekaiSiteHarvestResourceDrops']
-                info = {'site_id': site_id, 'drop_count': len(resource_drops)}
-                ret.append(info)
-            return ret
-        return None
+        ret = []
+        for harvest_map in harvest_maps:
+            site_id = harvest_map['mysekaiSiteId']
+            resource_drops = harvest_map['userMysekaiSiteHarvestResourceDrops']
+            find_drop = [
+                drop for drop in resource_drops
+                if drop['resourceId'] == resource_id
+            ]
+            for drop in find_drop:
+                ret.append(DiamondPlace(site_id, drop))
+        return ret
+
+    @classmethod
+    def get_remain_harvest_count(cls, decrypted_data: dict):
+        harvest_maps = cls.extract_harvest_map(decrypted_data)
+        if harvest_maps is None:
+            return None
+        return cls.count_remain_harvest(harvest_maps)
+
+    @staticmethod
+    def count_remain_harvest(harvest_maps: list[dict[str, Any]]
+                             | HarvestMapTable):
+        if isinstance(harvest_maps, HarvestMapTable):
+            table = harvest_maps
+            return [{
+                'site_id': site_id,
+                'drop_count': len(table.site_drops(i))
+            } for i, site_id in enumerate(table.sites)]
+
+        ret = []
+        for harvest_map in harvest_maps:
+            site_id = harvest_map['mysekaiSiteId']
+            resource_drops = harvest_map['userMysekaiSiteHarvestResourceDrops']
+            info = {'site_id': site_id, 'drop_count': len(resource_drops)}
+            ret.append(info)
+        return ret
 
     @staticmethod
     def extract_user_id(url: str) -> Optional[str]:
@@ -381,6 +739,38 @@ class SekaiTool:
             return harvest_maps
         return None
 
+    @classmethod
+    def decode_package(cls, pack: NetworkPackage) -> HarvestPackage:
+        decrypted_data = cls.decrypt_data(pack.data, HARVEST_MAP_PATHS)
+        harvest_maps = cls.extract_harvest_map(decrypted_data)
+        return HarvestPackage(pack.url, harvest_maps, pack.captured)
+
+    @classmethod
+    def process_package(
+            cls, pack: NetworkPackage | HarvestPackage
+    ) -> Optional[PacketResult]:
+        timings = {}
+        start = time.perf_counter()
+        if isinstance(pack, NetworkPackage):
+            pack = cls.decode_package(pack)
+            timings['decrypt'] = time.perf_counter() - start
+            start = time.perf_counter()
+        if pack.harvest_maps is None:
+            return None
+        table = HarvestMapTable.from_harvest_maps(pack.harvest_maps)
+        harvest_count = cls.count_remain_harvest(table)
+        diamonds = cls.find_diamond_in_maps(table, 12)
+        current_ids = cls.current_exist_ids(table)
+        timings['extract'] = time.perf_counter() - start
+        return PacketResult(pack.url, table, harvest_count, diamonds,
+                            current_ids, timings)
+
+    @staticmethod
+    def index_harvest_maps(harvest_maps: list[dict[str, Any]]
+                           | HarvestMapTable):
+        table = HarvestMapTable.of(harvest_maps)
+        return [SiteIndex(table, i) for i in range(len(table.sites))]
+
     @classmethod
     def find_fixture(
         cls,
@@ -401,13 +791,32 @@ class SekaiTool:
         pos_x: int,
         pos_z: int,
     ):
-        sekai_material = SekaiResources.instance()
         found_drops = [
             d for d in drops
             if d['positionX'] == pos_x and d['positionZ'] == pos_z
         ]
+        return cls.summary_items(found_drops)
+
+    @classmethod
+    def summary_rows(cls, table: HarvestMapTable, rows: list[int]):
+        sekai_material = SekaiResources.instance()
+        items: dict[tuple[int, int], OtherItems] = {}
+        for row in rows:
+            index = (table.drop_type[row], table.drop_id[row])
+            quantity = table.drop_quantity[row]
+            if index not in items:
+                res_type = table.resource_types[index[0]]
+                res_name = sekai_material.get_resource(res_type, index[1])
+                items[index] = OtherItems(res_name, quantity)
+            else:
+                items[index].quantity += quantity
+        return list(items.values())
+
+    @classmethod
+    def summary_items(cls, drops: list[dict[str, Any]]):
+        sekai_material = SekaiResources.instance()
         items: dict[tuple[str, int], OtherItems] = {}
-        for drop in found_drops:
+        for drop in drops:
             res_type: str = drop['resourceType']
             res_id: int = drop['resourceId']
             index = (res_type, res_id)
@@ -425,73 +834,104 @@ class SekaiTool:
         harvest_maps: dict,
         resource_type: str,
         resource_id: int,
+        site_indexes: Optional[list[SiteIndex]] = None,
+        with_raw: bool = True,
     ):
-        sekai_material = SekaiResources.instance()
-        ret: dict[ResourceIndex, ResourcePlace] = {}
-        for harvest_map in harvest_maps:
-            site_id: int = harvest_map['mysekaiSiteId']
-            place_name = cls.get_place_name(site_id)
-            drops: list[dict[str, Any]] = (
-                harvest_map['userMysekaiSiteHarvestResourceDrops'])
-            fixtures: list[dict[str, Any]] = (
-                harvest_map['userMysekaiSiteHarvestFixtures'])
-            find_drop = [
-                drop for drop in drops
-                if (drop['resourceId'] == resource_id
-                    and drop['resourceType'] == resource_type)
-            ]
+        key = (resource_type, resource_id)
+        found = cls.extract_resources_batch(harvest_maps, [key], site_indexes,
+                                            with_raw)
+        return found[key]
 
-            for drop in find_drop:
-                res_type = drop['resourceType']
-                res_id = drop['resourceId']
-                res_name = sekai_material.get_resource(res_type, res_id)
-                pos_x = drop['positionX']
-                pos_z = drop['positionZ']
-                quantity = drop['quantity']
-                limit = drop.get(
-                    'mysekaiSiteHarvestSpawnLimitedRelationGroupId')
+    @classmethod
+    def extract_resources_batch(
+        cls,
+        harvest_maps: dict,
+        keys: Optional[Iterable[tuple[str, int]]] = None,
+        site_indexes: Optional[list[SiteIndex]] = None,
+        with_raw: bool = True,
+    ) -> dict[tuple[str, int], list[ResourcePlace]]:
+        # Building the site indexes is the only pass over the drops, every
+        # requested (resource_type, resource_id) is then a lookup. With keys
+        # set to None all resources on the map are extracted.
+        if site_indexes is None:
+            site_indexes = cls.index_harvest_maps(harvest_maps)
+        found: dict[tuple[str, int], dict[ResourceIndex, ResourcePlace]] = {}
+        if keys is not None:
+            found = {key: {} for key in keys}
+        for site in site_indexes:
+            site_keys = site.resources if keys is None else found
+            for res_type, res_id in site_keys:
+                ret = found.setdefault((res_type, res_id), {})
+                cls.extract_site_resources(site, res_type, res_id, ret,
+                                           with_raw)
+        return {key: list(ret.values()) for key, ret in found.items()}
 
-                index = ResourceIndex(site_id, res_type, res_id, pos_x, pos_z,
-                                      limit)
-
-                if index not in ret:
-                    found_fixture = cls.find_fixture(fixtures, pos_x, pos_z)
-                    fixture_name = 'Not found'
-                    if len(found_fixture) > 0:
-                        fixture = found_fixture[0]
-                        fixture_id = fixture['mysekaiSiteHarvestFixtureId']
-                        fixture_name = cls.get_fixture_name(fixture_id)
-                    other_items = cls.summary_other_item(drops, pos_x, pos_z)
-                    raw_data = [DiamondPlace(site_id, drop)]
-
-                    res = ResourcePlace(res_name, place_name, pos_x, pos_z,
-                                        quantity, limit, fixture_name,
-                                        other_items, raw_data)
-                    ret[index] = res
-                else:
-                    res = ret[index]
-                    res.quantity += quantity
-                    res.raw_data.append(DiamondPlace(site_id, drop))
-        return list(ret.values())
+    @classmethod
+    def extract_site_resources(
+        cls,
+        site: SiteIndex,
+        resource_type: str,
+        resource_id: int,
+        ret: dict[ResourceIndex, ResourcePlace],
+        with_raw: bool = True,
+    ):
+        # Without with_raw the ResourcePlace.raw_data lists stay empty, which
+        # skips building a dict per drop.
+        sekai_material = SekaiResources.instance()
+        table = site.table
+        site_id = site.site_id
+        place_name = cls.get_place_name(site_id)
+        res_name = sekai_material.get_resource(resource_type, resource_id)
+
+        for row in site.find_drops(resource_type, resource_id):
+            pos_x = table.drop_x[row]
+            pos_z = table.drop_z[row]
+            quantity = table.drop_quantity[row]
+            limit = table.drop_spawn_limit(row)
+
+            index = ResourceIndex(site_id, resource_type, resource_id, pos_x,
+                                  pos_z, limit)
+
+            if index not in ret:
+                fixture_id = site.find_fixture(pos_x, pos_z)
+                fixture_name = 'Not found'
+                if fixture_id is not None:
+                    fixture_name = cls.get_fixture_name(fixture_id)
+                other_items = site.summaries.get((pos_x, pos_z))
+                if other_items is None:
+                    other_items = cls.summary_rows(
+                        table, site.drops_at_position(pos_x, pos_z))
+                    site.summaries[(pos_x, pos_z)] = other_items
+                raw_data = []
+                if with_raw:
+                    raw_data.append(DiamondPlace(site_id, table.drop(row)))
+
+                res = ResourcePlace(res_name, place_name, pos_x, pos_z,
+                                    quantity, limit, fixture_name,
+                                    other_items, raw_data, index)
+                ret[index] = res
+            else:
+                res = ret[index]
+                res.quantity += quantity
+                if with_raw:
+                    res.raw_data.append(DiamondPlace(site_id, table.drop(row)))
 
     @classmethod
-    def current_exist_ids(cls, harvest_maps: dict):
-        ret = {
+    def current_exist_ids(cls, harvest_maps: list[dict[str, Any]]
+                          | HarvestMapTable):
+        table = HarvestMapTable.of(harvest_maps)
+        ret: dict[str, set[int]] = {
             'mysekai_material': set(),
             'mysekai_item': set(),
             'material': set(),
             'mysekai_fixture': set(),
         }
 
-        for harvest_map in harvest_maps:
-            drops: list[dict[str, Any]] = (
-                harvest_map['userMysekaiSiteHarvestResourceDrops'])
-            for drop in drops:
-                res_type = drop['resourceType']
-                if res_type not in ret:
-                    continue
-                res_id = drop['resourceId']
-                ret[res_type].add(int(res_id))
+        for code, res_id in set(zip(table.drop_type, table.drop_id)):
+            res_type = table.resource_types[code]
+            if res_type not in ret:
+                continue
+            ret[res_type].add(res_id)
         return ret
 
 
@@ -1,15 +1,54 @@
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
 from dataclasses import dataclass, field
 from nicegui import ui, background_tasks, app, Event, run
-from queue import Queue, Empty
-from collections import deque
+from fastapi.responses import PlainTextResponse
+from queue import Empty
+from collections import deque, OrderedDict
 import logging
 from datetime import datetime
 import time
 import json
-
-from utils import DiamondPlace, ResourcePlace, SekaiResources, SekaiTool, NetworkPackage
-from manager import QueueManager
+from typing import Any, Optional
+
+from utils import (DiamondPlace, ResourcePlace, SekaiResources, SekaiTool,
+                   NetworkPackage, HarvestPackage, PacketResult,
+                   HarvestMapTable, SiteIndex)
+from manager import (QueueManager, LatestQueue, get_transport_config,
+                     unpack_batch)
+from shared_state import SharedState, UserState, ROLES, STATE_PATH
+from broker import BrokerConsumer, BROKER_ADDRESS, DEFAULT_GROUP
+from transport import TRANSPORTS, SpoolPackage, discard, process_spooled
+from metrics import REGISTRY, SIZE_BUCKETS, observe_stage, stage_histogram
+
+RECEIVE_TIMEOUT = 5
+RECEIVE_BATCH = 32
+# Seconds between samples of the hub queue stats, taken while receiving.
+HUB_STATS_INTERVAL = 1
+# Number of processes decoding packets, 0 decodes on the event loop.
+WORKER_COUNT = int(os.environ.get('SEKAI_WORKERS', os.cpu_count() or 1))
+RESULT_CACHE_SIZE = 256
+# Payload transport published to the manager on connect ('queue' or 'shm'),
+# unset keeps whatever the manager was started with.
+TRANSPORT = os.environ.get('SEKAI_TRANSPORT')
+SPOOL_DIR = os.environ.get('SEKAI_SPOOL_DIR')
+# Where packets come from, 'manager' or 'broker', and the broker group this
+# process consumes.
+HUB = os.environ.get('SEKAI_HUB', 'manager')
+BROKER_GROUP = os.environ.get('SEKAI_BROKER_GROUP', DEFAULT_GROUP)
+# Master data source ({repo} and {file} template, URL or local path) and
+# the on-disk cache of the parsed name tables.
+MASTER_URL = os.environ.get('SEKAI_MASTER_URL')
+MASTER_CACHE = os.environ.get('SEKAI_MASTER_CACHE', SekaiResources.CACHE_PATH)
+# 'standalone' keeps state in memory only. With several webapp processes one
+# 'writer' consumes packets into the shared state and 'reader's follow it.
+ROLE = os.environ.get('SEKAI_ROLE', 'standalone')
+STATE_DB = os.environ.get('SEKAI_STATE_DB', STATE_PATH)
+STATE_POLL_INTERVAL = 0.5
+PORT = int(os.environ.get('SEKAI_PORT', 8080))
 
 
 class DequeLogger(logging.Handler):
@@ -32,6 +71,45 @@ class DequeLogger(logging.Handler):
             self.handleError(record)
 
 
+class ResultCache:
+    '''LRU store of extracted resources per (user, resource_type, id).
+
+    Entries are only built when queried. Each one is stamped with the map
+    and name table versions it was extracted from, a newer map replaces
+    the entry in place rather than leaving stale versions in the LRU.
+    '''
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.items: OrderedDict[tuple, tuple[tuple, list[ResourcePlace]]] = (
+            OrderedDict())
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, stamp: tuple) -> Optional[list[ResourcePlace]]:
+        entry = self.items.get(key)
+        if entry is None or entry[0] != stamp:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: tuple, stamp: tuple, value: list[ResourcePlace]):
+        self.items[key] = (stamp, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def stats(self):
+        return {
+            'size': len(self.items),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
 @dataclass
 class LastDiamondStatus:
     last_update: float = 0
@@ -41,8 +119,12 @@ class LastDiamondStatus:
 @dataclass
 class LastHarvestMapStatus:
     last_update: float = 0
-    harvest_map: dict = field(default_factory=dict)
+    version: int = 0
+    names_version: int = 0
+    harvest_map: HarvestMapTable = field(default_factory=HarvestMapTable)
     current_ids: dict[str, set[int]] = field(default_factory=dict)
+    # Built on the first query after an update, see Storage.site_indexes.
+    site_indexes: Optional[list[SiteIndex]] = None
 
 
 class Storage:
@@ -64,10 +146,27 @@ class Storage:
                 'mysekaiSiteHarvestSpawnLimitedRelationGroupId': 2503,
             })
 
-        self.event = Event[str]()
+        self.user_events: dict[str, Event[str]] = {}
         self.last_found_diamonds: dict[str, LastDiamondStatus] = {}
         self.last_harvest_map: dict[str, LastHarvestMapStatus] = {}
-        pass
+        self.result_cache = ResultCache(RESULT_CACHE_SIZE)
+        self.shared_state: Optional[SharedState] = None
+        # Latest LatestQueue.stats() of the hub queue this process reads.
+        self.hub_stats: dict[str, int] = {}
+        self.hub_stats_time = 0.0
+        self.register_metrics()
+
+    def register_metrics(self):
+        for key in ['size', 'put', 'dropped', 'coalesced']:
+            REGISTRY.gauge(f'sekai_hub_queue_{key}',
+                           lambda key=key: self.hub_stats.get(key),
+                           f'Hub queue {key}')
+        REGISTRY.gauge('sekai_users', lambda: len(self.last_harvest_map),
+                       'Users with a harvest map')
+        for key in ['size', 'hits', 'misses']:
+            REGISTRY.gauge(f'sekai_result_cache_{key}',
+                           lambda key=key: self.result_cache.stats()[key],
+                           f'Resource query cache {key}')
 
     @classmethod
     def instance(cls):
@@ -82,29 +181,110 @@ class Storage:
         self.messages.clear()
         show_messages.refresh()
 
-    def update_diamonds(self, user_id: str, diamonds: list[DiamondPlace]):
+    def update_diamonds(self,
+                        user_id: str,
+                        diamonds: list[DiamondPlace],
+                        last_update: Optional[float] = None):
         if user_id not in self.last_found_diamonds:
             status = LastDiamondStatus()
             self.last_found_diamonds[user_id] = status
         else:
             status = self.last_found_diamonds[user_id]
-        status.last_update = time.time()
+        status.last_update = last_update or time.time()
         status.diamonds = diamonds
 
-    def update_harvest_map(self, user_id: str, harvest_maps: dict):
+    def update_harvest_map(self,
+                           user_id: str,
+                           harvest_maps: list[dict] | HarvestMapTable,
+                           current_ids: Optional[dict[str, set[int]]] = None,
+                           last_update: Optional[float] = None):
+        table = HarvestMapTable.of(harvest_maps)
         if user_id not in self.last_harvest_map:
             status = LastHarvestMapStatus()
             self.last_harvest_map[user_id] = status
         else:
             status = self.last_harvest_map[user_id]
-        status.last_update = time.time()
-        status.harvest_map = harvest_maps
-
-        exist_ids = SekaiTool.current_exist_ids(harvest_maps)
-        status.current_ids = exist_ids
+        status.last_update = last_update or time.time()
+        status.version += 1
+        status.harvest_map = table
+        status.site_indexes = None
+
+        if current_ids is None:
+            current_ids = SekaiTool.current_exist_ids(table)
+        status.current_ids = current_ids
+
+    def site_indexes(self, status: LastHarvestMapStatus) -> list[SiteIndex]:
+        # Indexed lazily so packets of users nobody is looking at cost no
+        # work on the event loop. The position summaries cached in the
+        # indexes carry resolved names, remember which name tables they were
+        # built from so a master data refresh rebuilds them.
+        names_version = SekaiResources.instance().version
+        if (status.site_indexes is None
+                or status.names_version != names_version):
+            status.names_version = names_version
+            status.site_indexes = SekaiTool.index_harvest_maps(
+                status.harvest_map)
+        return status.site_indexes
+
+    def query_resources_batch(
+        self, user_id: str, keys: list[tuple[str, int]]
+    ) -> dict[tuple[str, int], list[ResourcePlace]]:
+        status = self.last_harvest_map.get(user_id)
+        if status is None:
+            return {key: [] for key in keys}
+        site_indexes = self.site_indexes(status)
+
+        stamp = (status.version, status.names_version)
+        ret: dict[tuple[str, int], list[ResourcePlace]] = {}
+        missing: list[tuple[str, int]] = []
+        for key in keys:
+            found = self.result_cache.get((user_id, *key), stamp)
+            if found is None:
+                missing.append(key)
+            else:
+                ret[key] = found
+        if missing:
+            # One pass over the site indexes for every key not cached.
+            extracted = SekaiTool.extract_resources_batch(status.harvest_map,
+                                                          missing,
+                                                          site_indexes,
+                                                          with_raw=False)
+            for key, found in extracted.items():
+                self.result_cache.put((user_id, *key), stamp, found)
+                ret[key] = found
+        return {key: ret[key] for key in keys}
+
+    def user_state(self, user_id: str) -> UserState:
+        harvest = self.last_harvest_map[user_id]
+        diamond = self.last_found_diamonds.get(user_id, LastDiamondStatus())
+        return UserState(user_id, harvest.last_update, harvest.harvest_map,
+                         harvest.current_ids, diamond.last_update,
+                         diamond.diamonds)
+
+    def apply_state(self, state: UserState):
+        self.update_harvest_map(state.user_id, state.harvest_map,
+                                state.current_ids, state.map_update)
+        self.update_diamonds(state.user_id, state.diamonds,
+                             state.diamond_update)
+
+    def subscribe_user(self, user_id: str, callback):
+        event = self.user_events.get(user_id)
+        if event is None:
+            event = Event[str]()
+            self.user_events[user_id] = event
+        event.subscribe(callback)
+
+        def on_delete():
+            event.unsubscribe(callback)
+            if not event.callbacks and self.user_events.get(user_id) is event:
+                del self.user_events[user_id]
+
+        ui.context.client.on_delete(on_delete)
 
     def emit_event(self, user_id):
-        self.event.emit(user_id)
+        event = self.user_events.get(user_id)
+        if event is not None:
+            event.emit(user_id)
 
     def append_example(self, user_id: str):
         diamonds = [self.example_diamond] * 2
@@ -117,72 +297,299 @@ class Storage:
         self.emit_event(user_id)
 
 
-def try_find_diamond(pack: NetworkPackage):
+class PacketWorkerPool:
+    INSTANCE = None
+
+    def __init__(self, max_workers: int) -> None:
+        self.max_workers = max_workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    @classmethod
+    def instance(cls):
+        if cls.INSTANCE is None:
+            cls.INSTANCE = cls(WORKER_COUNT)
+        return cls.INSTANCE
+
+    async def process(
+        self, pack: NetworkPackage | HarvestPackage | SpoolPackage
+    ) -> Optional[PacketResult]:
+        # Spooled payloads are mapped and decoded by whoever processes them,
+        # only the descriptor crosses into the worker.
+        func = SekaiTool.process_package
+        if isinstance(pack, SpoolPackage):
+            func = process_spooled
+        if self.max_workers <= 0:
+            return func(pack)
+        loop = asyncio.get_running_loop()
+        executor = self.pool()
+        try:
+            return await loop.run_in_executor(executor, func, pack)
+        except BrokenProcessPool:
+            # A dead worker (OOM, crash in native code) breaks the whole
+            # pool for good. Replace it and retry the packet once.
+            logging.getLogger().error('worker pool broken, restarting it')
+            self.discard(executor)
+            return await loop.run_in_executor(self.pool(), func, pack)
+
+    def pool(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            context = multiprocessing.get_context('spawn')
+            self.executor = ProcessPoolExecutor(self.max_workers,
+                                                mp_context=context)
+        return self.executor
+
+    def discard(self, executor: ProcessPoolExecutor):
+        # Every packet in flight fails on the broken pool, only the first
+        # one replaces it.
+        if self.executor is executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+def apply_result(user_id: str, result: PacketResult):
     logger = logging.getLogger()
+    storage = Storage.instance()
+    logger.info('harvest_count: %s', result.harvest_count)
+    storage.update_harvest_map(user_id, result.harvest_maps,
+                               result.current_ids)
+    if result.diamonds:
+        logger.info('Find diamond')
+        for d in result.diamonds:
+            logger.info('%s', d)
+    else:
+        logger.info('Diamond not found')
+    storage.update_diamonds(user_id, result.diamonds)
+
+
+def receive_packages(queue: LatestQueue, timeout: float, max_batch: int):
     try:
-        storage = Storage.instance()
+        packs = unpack_batch(queue.get(timeout=timeout))
+    except Empty:
+        # An idle receive doubles as a heartbeat for the stats.
+        sample_hub_stats(queue.stats)
+        return []
+    while len(packs) < max_batch:
+        try:
+            packs.extend(unpack_batch(queue.get_nowait()))
+        except Empty:
+            break
+    sample_hub_stats(queue.stats)
+    return packs
+
+
+def sample_hub_stats(stats):
+    # At most one extra round trip per HUB_STATS_INTERVAL, not per batch.
+    storage = Storage.instance()
+    now = time.monotonic()
+    if now - storage.hub_stats_time >= HUB_STATS_INTERVAL:
+        storage.hub_stats_time = now
+        storage.hub_stats = stats()
+
+
+RECEIVED = REGISTRY.counter('sekai_webapp_received_packets',
+                            'Packets taken from the hub')
+PROCESSED = REGISTRY.counter('sekai_webapp_updated_users',
+                             'User updates applied and emitted')
+RECEIVE_BATCH_SIZE = REGISTRY.histogram('sekai_webapp_receive_batch_size',
+                                        'Packets per receive from the hub',
+                                        SIZE_BUCKETS)
+
+
+async def handle_packages(
+        packs: list[NetworkPackage | HarvestPackage | SpoolPackage]):
+    logger = logging.getLogger()
+    storage = Storage.instance()
+    pool = PacketWorkerPool.instance()
+    users: list[str] = []
+    tasks = []
+    captured: dict[str, float] = {}
+    now = time.time()
+    RECEIVED.inc(len(packs))
+    RECEIVE_BATCH_SIZE.observe(len(packs))
+    for pack in packs:
+        if pack.captured:
+            observe_stage('queue', now - pack.captured)
+        logger.info('get pack for: %s', pack.url)
+        if isinstance(pack, NetworkPackage):
+            logger.info('get data %s bytes', len(pack.data))
+        elif isinstance(pack, SpoolPackage):
+            logger.info('get spooled data %s bytes', pack.length)
         user_id = SekaiTool.extract_user_id(pack.url)
         if not user_id:
             logger.info('Cannot extract user_id')
-            return
-        decrypted_data = SekaiTool.decrypt_data(pack.data)
-        harvest_count = SekaiTool.get_remain_harvest_count(decrypted_data)
-        logger.info('harvest_count: %s', harvest_count)
-
-        harvest_map = SekaiTool.extract_harvest_map(decrypted_data)
-        if harvest_map is not None:
-            storage.update_harvest_map(user_id, harvest_map)
-
-        ret = SekaiTool.find_diamond(decrypted_data, 12)
-        # ret = find_diamond(decrypted_data, 1)
-        if ret is None:
-            return
-        if ret:
-            logger.info('Find diamond')
-            for d in ret:
-                logger.info('%s', d)
-        else:
-            logger.info('Diamond not found')
-        storage.update_diamonds(user_id, ret)
-        storage.emit_event(user_id)
-    except Exception as ex:
-        logger.error('Exception: %s %s', type(ex), ex)
+            if isinstance(pack, SpoolPackage):
+                discard(pack)
+            continue
+        users.append(user_id)
+        tasks.append(pool.process(pack))
+        if pack.captured:
+            captured[user_id] = max(captured.get(user_id, 0), pack.captured)
+
+    # Packets are decoded in parallel, but results are applied in the order
+    # they were received so a user's older map never overwrites a newer one.
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    updated_users: list[str] = []
+    for user_id, result in zip(users, results):
+        if isinstance(result, BaseException):
+            logger.error('Exception: %s %s', type(result), result)
+            continue
+        if result is None:
+            continue
+        for stage, seconds in result.timings.items():
+            observe_stage(stage, seconds)
+        with stage_histogram('apply').time():
+            apply_result(user_id, result)
+        if user_id not in updated_users:
+            updated_users.append(user_id)
+    if storage.shared_state is not None and updated_users:
+        states = [storage.user_state(user_id) for user_id in updated_users]
+        try:
+            with stage_histogram('state_write').time():
+                await run.io_bound(storage.shared_state.write, states)
+        except Exception as e:
+            logger.error('write shared state fail: %s %s', type(e), e)
+    for user_id in updated_users:
+        with stage_histogram('emit').time():
+            storage.emit_event(user_id)
+        if user_id in captured:
+            observe_stage('total', time.time() - captured[user_id])
+    PROCESSED.inc(len(updated_users))
+
+
+async def io_bound_result(func, *args):
+    # run.io_bound swallows cancellation and returns None once the app is
+    # stopping. For functions that never return None, turn that back into
+    # a CancelledError so loops around them end instead of spinning.
+    ret = await run.io_bound(func, *args)
+    if ret is None:
+        raise asyncio.CancelledError
+    return ret
+
+
+def publish_transport(manager: QueueManager):
+    if TRANSPORT not in TRANSPORTS:
+        raise ValueError(f'Unknown transport {TRANSPORT}')
+    config = manager.get_transport()
+    config['transport'] = TRANSPORT
+    if SPOOL_DIR:
+        config['spool_dir'] = SPOOL_DIR
 
 
 async def background_handle():
     logger = logging.getLogger()
     manager = QueueManager(address=('', 50000), authkey=b'abracadabra')
-    manager.connect()
-    queue: Queue = manager.get_queue()
-    logger.info('connect to manager')
+    await run.io_bound(manager.connect)
+    queue: LatestQueue = await io_bound_result(manager.get_queue)
+    if TRANSPORT:
+        await run.io_bound(publish_transport, manager)
+    config = await run.io_bound(get_transport_config, manager)
+    logger.info('connect to manager, transport %s', config['transport'])
     while True:
-        await asyncio.sleep(1)
-        try:
-            pack: NetworkPackage = queue.get_nowait()
-            logger.info('get pack for: %s', pack.url)
-            logger.info('get data %s bytes', len(pack.data))
-            try_find_diamond(pack)
-        except Empty:
-            pass
+        # Block in a worker thread until a packet arrives, then drain
+        # everything already pending so a burst is handled as one batch.
+        packs = await io_bound_result(receive_packages, queue,
+                                      RECEIVE_TIMEOUT, RECEIVE_BATCH)
+        if packs:
+            await handle_packages(packs)
+
+
+async def background_handle_broker():
+    logger = logging.getLogger()
+    consumer = await BrokerConsumer.connect(BROKER_ADDRESS, BROKER_GROUP)
+    logger.info('connect to broker %s, transport %s', BROKER_ADDRESS,
+                consumer.transport['transport'])
+    try:
+        while True:
+            # The broker holds the request until packets arrive, so no
+            # thread is needed to wait.
+            packs = await consumer.get(RECEIVE_BATCH, RECEIVE_TIMEOUT)
+            storage = Storage.instance()
+            if time.monotonic() - storage.hub_stats_time >= HUB_STATS_INTERVAL:
+                storage.hub_stats_time = time.monotonic()
+                groups = await consumer.stats()
+                storage.hub_stats = groups.get(BROKER_GROUP, {})
+            # Every get reply carries the current depth of the group.
+            storage.hub_stats['size'] = consumer.pending
+            if packs:
+                await handle_packages(packs)
+    finally:
+        await consumer.close()
 
 
 async def background():
     logger = logging.getLogger()
+    handle = background_handle
+    if HUB == 'broker':
+        handle = background_handle_broker
     while True:
         try:
-            await background_handle()
+            await handle()
         except Exception as e:
             logger.error('background connect fail: %s %s', type(e), e)
             await asyncio.sleep(10)
             pass
 
 
+def open_shared_state():
+    logger = logging.getLogger()
+    if ROLE not in ROLES:
+        raise ValueError(f'Unknown role {ROLE}')
+    if ROLE == 'standalone':
+        return
+    storage = Storage.instance()
+    storage.shared_state = SharedState(STATE_DB)
+    # The writer picks up where it stopped, readers catch up to the writer.
+    states = storage.shared_state.read_changes()
+    for state in states:
+        storage.apply_state(state)
+    logger.info('open shared state %s as %s, %s users', STATE_DB, ROLE,
+                len(states))
+
+
+async def background_state_sync():
+    logger = logging.getLogger()
+    storage = Storage.instance()
+    while True:
+        await asyncio.sleep(STATE_POLL_INTERVAL)
+        try:
+            states = await io_bound_result(storage.shared_state.read_changes)
+        except Exception as e:
+            logger.error('read shared state fail: %s %s', type(e), e)
+            continue
+        for state in states:
+            storage.apply_state(state)
+            storage.emit_event(state.user_id)
+
+
+def start_background():
+    if ROLE == 'reader':
+        background_tasks.create(background_state_sync())
+    else:
+        background_tasks.create(background())
+
+
+def load_material_cache():
+    logger = logging.getLogger()
+    SekaiResources.INSTANCE = SekaiResources(MASTER_URL, MASTER_CACHE)
+    try:
+        if SekaiResources.instance().load_cache():
+            logger.info('load material cache from %s', MASTER_CACHE)
+    except Exception as e:
+        logger.error('load material cache fail: %s %s', type(e), e)
+
+
 async def background_material():
     logger = logging.getLogger()
     while True:
         try:
             sekai_material = SekaiResources.instance()
-            sekai_material.update()
+            if await run.io_bound(sekai_material.update):
+                logger.info('material names updated')
             await asyncio.sleep(86400)
         except Exception as e:
             logger.error('update material fail: %s %s', type(e), e)
@@ -197,6 +604,92 @@ def show_messages():
         log.push(i)
 
 
+class ResourceCard:
+
+    def __init__(self, res: ResourcePlace):
+        self.card = ui.card().classes('w-full')
+        with self.card:
+            with ui.card_section():
+                self.name = ui.label().classes('text-lg font-bold')
+
+            with ui.card_section():
+                self.place = ui.label()
+                self.position = ui.label()
+                self.quantity = ui.label()
+                self.spawn_limit = ui.label().classes('text-sm text-blue-600')
+                self.fixture = ui.label().classes('text-sm text-purple-600')
+                self.other_title = ui.label('其他物品:').classes(
+                    'text-sm text-gray-500')
+                self.other_row = ui.row().classes('flex-wrap gap-2')
+        self.other_items: Optional[list[tuple[str, int]]] = None
+        self.update(res)
+
+    def update(self, res: ResourcePlace):
+        # Labels only push changes to the browser when the value differs.
+        self.name.set_text(res.resource_name)
+        self.place.set_text(f'📍 {res.place_name}')
+        self.position.set_text(f'坐標: ({res.position_x}, {res.position_z})')
+        self.quantity.set_text(f'數量: {res.quantity}')
+        self.spawn_limit.set_text(f'期間限定: {res.spawn_limit}')
+        self.spawn_limit.set_visibility(res.spawn_limit is not None)
+        self.fixture.set_text(f'Fixture: {res.fixture_name}')
+        self.fixture.set_visibility(bool(res.fixture_name))
+
+        other_items = [(it.resouce_name, it.quantity)
+                       for it in res.fixture_all_items]
+        if other_items == self.other_items:
+            return
+        self.other_items = other_items
+        self.other_title.set_visibility(bool(other_items))
+        self.other_row.clear()
+        with self.other_row:
+            for item_name, item_qty in other_items:
+                ui.label(f'{item_name} x {item_qty}').classes(
+                    'text-sm bg-gray-100 px-2 py-1 rounded')
+
+
+class ResourceCardList:
+
+    def __init__(self):
+        self.empty_label = ui.label('No Resources Found').classes(
+            'text-gray-500')
+        self.grid = ui.grid().classes(
+            'w-full grid grid-cols-1 md:grid-cols-2 gap-4')
+        self.cards: dict[Any, ResourceCard] = {}
+
+    def clear(self):
+        self.empty_label.set_visibility(False)
+        for card in self.cards.values():
+            card.card.delete()
+        self.cards = {}
+
+    def update(self, found_resources: list[ResourcePlace]):
+        self.empty_label.set_visibility(not found_resources)
+
+        keys = []
+        for res in found_resources:
+            key = res.index
+            if key is None:
+                key = (res.place_name, res.resource_name, res.position_x,
+                       res.position_z, res.spawn_limit)
+            keys.append(key)
+            card = self.cards.get(key)
+            if card is None:
+                with self.grid:
+                    self.cards[key] = ResourceCard(res)
+            else:
+                card.update(res)
+
+        for key in set(self.cards) - set(keys):
+            self.cards.pop(key).card.delete()
+
+        # Only reorder when the order of the cards changed.
+        if list(self.cards) != keys:
+            for i, key in enumerate(keys):
+                self.cards[key].card.move(target_index=i)
+            self.cards = {key: self.cards[key] for key in keys}
+
+
 class InitialPage():
 
     def __init__(self):
@@ -237,8 +730,8 @@ class MainPage():
         with ui.column().classes('w-full max-w-3xl mx-auto'):
             self.current_id = app.storage.user['user_id']
             ui.label(f'Current ID: {self.current_id}')
-            self.event = Storage.instance().event
-            self.event.subscribe(self.on_update_event)
+            Storage.instance().subscribe_user(self.current_id,
+                                              self.on_update_event)
             # self.show_diamonds()
 
             # Resource Type Selection Section
@@ -269,9 +762,10 @@ class MainPage():
                     resources = SekaiResources.instance()
                     self.select_res = ui.select(
                         resources.get_all_mysekai_material(),
-                        value=12,
-                        on_change=self.show_resources.refresh,
-                    ).classes('flex-grow')
+                        value=[12],
+                        multiple=True,
+                        on_change=self.update_resources,
+                    ).classes('flex-grow').props('use-chips')
 
             self.show_resources()
 
@@ -308,72 +802,51 @@ class MainPage():
                     }
                     options = new_options
 
-        self.select_res.set_options(options)
-        self.show_resources.refresh()
+        selected = [v for v in self.select_res.value or [] if v in options]
+        self.select_res.set_options(options, value=selected)
+        self.update_resources()
 
     def on_update_event(self, msg: str):
         user_id = msg
         if user_id == self.current_id:
             # self.show_diamonds.refresh()
-            self.show_resources.refresh()
+            self.update_resources()
 
-    @ui.refreshable_method
     def show_resources(self):
+        self.resource_status = ui.label()
+        self.resource_message = ui.label()
+        self.resource_cards = ResourceCardList()
+        self.update_resources()
+
+    def update_resources(self):
         storage = Storage.instance()
         status = storage.last_harvest_map.get(self.current_id)
+        self.resource_status.set_visibility(status is not None)
         if not status:
-            ui.label('Waiting for network packets...')
+            self.show_resource_message('Waiting for network packets...')
             return
-        harvest_map = status.harvest_map
         last_update = datetime.fromtimestamp(status.last_update)
         last_update = last_update.isoformat(sep=' ', timespec='seconds')
-        ui.label(f'Last update: {last_update}')
+        self.resource_status.set_text(f'Last update: {last_update}')
 
-        selected_res_id = self.select_res.value
-        if selected_res_id is None:
-            ui.label('No selected resource id')
+        selected_res_ids = self.select_res.value
+        if not selected_res_ids:
+            self.show_resource_message('No selected resource id')
             return
         selected_res_type = self.radio_res_type.value
         if selected_res_type is None:
-            ui.label('No selected resource type')
-        found_resources = SekaiTool.extract_resources(harvest_map,
-                                                      str(selected_res_type),
-                                                      int(selected_res_id))
-        self.show_resources0(found_resources)
-
-    def show_resources0(self, found_resources: list[ResourcePlace]):
-        if not found_resources:
-            ui.label('No Resources Found').classes('text-gray-500')
+            self.show_resource_message('No selected resource type')
             return
+        keys = [(str(selected_res_type), int(i)) for i in selected_res_ids]
+        found = storage.query_resources_batch(self.current_id, keys)
+        found_resources = [res for key in keys for res in found[key]]
+        self.resource_message.set_visibility(False)
+        self.resource_cards.update(found_resources)
 
-        with ui.grid().classes('w-full grid grid-cols-1 md:grid-cols-2 gap-4'):
-            for res in found_resources:
-                with ui.card().classes('w-full'):
-                    with ui.card_section():
-                        ui.label(
-                            res.resource_name).classes('text-lg font-bold')
-
-                    with ui.card_section():
-                        ui.label(f'📍 {res.place_name}')
-                        ui.label(f'坐標: ({res.position_x}, {res.position_z})')
-                        ui.label(f'數量: {res.quantity}')
-                        if res.spawn_limit is not None:
-                            ui.label(f'期間限定: {res.spawn_limit}').classes(
-                                'text-sm text-blue-600')
-                        if res.fixture_name:
-                            ui.label(f'Fixture: {res.fixture_name}').classes(
-                                'text-sm text-purple-600')
-                        if res.fixture_all_items:
-                            ui.label('其他物品:').classes('text-sm text-gray-500')
-                            with ui.row().classes('flex-wrap gap-2'):
-                                for it in res.fixture_all_items:
-                                    item_name = it.resouce_name
-                                    item_qty = it.quantity
-                                    ui.label(
-                                        f'{item_name} x {item_qty}'
-                                    ).classes(
-                                        'text-sm bg-gray-100 px-2 py-1 rounded'
-                                    )
+    def show_resource_message(self, message: str):
+        self.resource_message.set_text(message)
+        self.resource_message.set_visibility(True)
+        self.resource_cards.clear()
 
     @ui.refreshable_method
     def show_diamonds(self):
@@ -419,6 +892,12 @@ class MainPage():
         ui.navigate.reload()
 
 
+@app.get('/metrics')
+def metrics():
+    return PlainTextResponse(REGISTRY.render(),
+                             media_type='text/plain; version=0.0.4')
+
+
 @ui.page('/')
 def main():
     if 'user_id' not in app.storage.user:
@@ -434,8 +913,11 @@ def main():
 #     show_messages()
 #     pass
 
+app.on_startup(load_material_cache)
 app.on_startup(lambda: background_tasks.create(background_material()))
-app.on_startup(lambda: background_tasks.create(background()))
+app.on_startup(open_shared_state)
+app.on_startup(start_background)
+app.on_shutdown(lambda: PacketWorkerPool.instance().shutdown())
 
 if __name__ in {"__main__", "__mp_main__"}:
     logging.basicConfig(level=logging.DEBUG,
@@ -448,6 +930,7 @@ if __name__ in {"__main__", "__mp_main__"}:
     root = logging.getLogger()
     root.addHandler(handler)
     ui.run(
+        port=PORT,
         reload=False,
         storage_secret='private key to secure the browser session cookie',
     )